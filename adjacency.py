@@ -0,0 +1,199 @@
+"""FIPS-keyed US county adjacency graph
+
+The graph is stored in CSR form: the neighbors of the county at index i
+are indices[indptr[i]:indptr[i + 1]], every index pointing into the
+FIPS-sorted `fips` and `names` arrays. A county is not its own neighbor.
+
+Regenerate the bundled graph from the census county_adjacency.txt with:
+python adjacency.py [county_adjacency.txt or URL] [county_adjacency.npz]
+"""
+import logging
+import os
+import string
+import sys
+import threading
+
+import numpy as np
+
+import requests
+
+COUNTY_ADJACENCY_URL = os.environ.get('COUNTY_ADJACENCY_URL',
+                                      'https://www2.census.gov/geo/docs/reference/county_adjacency.txt')
+# Characters of every US county name; anything else is a decoding error
+# (Ex- 'Do\xb1a Ana County, NM' for 'Doña Ana County, NM')
+NAME_CHARACTERS = frozenset(string.ascii_letters + string.digits + " ,.'-" + 'áéíóúüñÁÉÍÓÚÜÑ')
+ADJACENCY_PATH = os.environ.get(
+    'COUNTY_ADJACENCY_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'county_adjacency.npz'))
+
+logger = logging.getLogger(__name__)
+
+
+class CountyAdjacency(object):
+    """County adjacency graph with a name and FIPS index
+
+    :param fips: int32 array of county FIPS codes, sorted ascending
+    :param names: county names aligned with fips (Ex- Dallas County, TX)
+    :param indptr: int32 array of n + 1 offsets into indices
+    :param indices: int32 array of neighbor indices
+    """
+
+    def __init__(self, fips, names, indptr, indices):
+        self.fips = fips
+        self.names = names
+        self.indptr = indptr
+        self.indices = indices
+        self._by_name = {str(name): i for i, name in enumerate(names)}
+
+    def __len__(self):
+        return len(self.fips)
+
+    @classmethod
+    def from_census_text(cls, text):
+        """Builds the graph from the content of county_adjacency.txt
+
+        Each county starts a line with its quoted name and FIPS code
+        followed by its first neighbor; next neighbors are on lines with
+        the first two columns empty.
+
+        :raises ValueError: if a county name has a character no county
+            name has, i.e. the text was decoded with the wrong encoding
+        """
+        names = {}
+        pairs = []
+        county = None
+        for line in text.splitlines():
+            columns = line.split('\t')
+            if len(columns) < 4:
+                continue
+            if columns[0]:
+                county = int(columns[1])
+                names[county] = columns[0].strip('"')
+            neighbor = int(columns[3])
+            names.setdefault(neighbor, columns[2].strip('"'))
+            if county is not None and neighbor != county:
+                pairs.append((county, neighbor))
+        garbled = sorted(name for name in names.values() if not NAME_CHARACTERS.issuperset(name))
+        if garbled:
+            raise ValueError('County names not decoded cleanly: {}'.format(', '.join(garbled)))
+        fips = np.array(sorted(names), dtype=np.int32)
+        edges = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+        sources = np.searchsorted(fips, edges[:, 0])
+        targets = np.searchsorted(fips, edges[:, 1])
+        order = np.lexsort((targets, sources))
+        sources = sources[order]
+        targets = targets[order]
+        indptr = np.zeros(len(fips) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=len(fips)), out=indptr[1:])
+        return cls(fips, np.array([names[code] for code in fips]),
+                   indptr, targets.astype(np.int32))
+
+    @classmethod
+    def load(cls, path=ADJACENCY_PATH):
+        """Loads a graph saved with save()"""
+        with np.load(path) as data:
+            return cls(data['fips'], data['names'], data['indptr'], data['indices'])
+
+    def save(self, path=ADJACENCY_PATH):
+        """Saves the graph as an uncompressed .npz file"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.savez(path, fips=self.fips, names=self.names,
+                 indptr=self.indptr, indices=self.indices)
+
+    def index_of_fips(self, fips):
+        """Finds a county by FIPS code
+
+        :param fips: county FIPS code as int or string (Ex- '48113')
+        :returns: county index or None if the county is unknown
+        """
+        fips = int(fips)
+        index = int(np.searchsorted(self.fips, fips))
+        if index < len(self.fips) and self.fips[index] == fips:
+            return index
+        return None
+
+    def names_of_fips(self, fips):
+        """Finds several counties by FIPS code at once
+
+        :param fips: int array of county FIPS codes
+        :returns: list of the names of the known counties
+        """
+        if not len(self.fips):
+            return []
+        indices = np.minimum(np.searchsorted(self.fips, fips), len(self.fips) - 1)
+        return [str(self.names[index]) for index in indices[self.fips[indices] == fips]]
+
+    def index_of_name(self, name):
+        """Finds a county by name
+
+        :param name: county name with state short (Ex- Dallas County, TX)
+        :returns: county index or None if the county is unknown
+        """
+        return self._by_name.get(name)
+
+    def fips_code(self, index):
+        """Returns the 5 digit FIPS code of a county (Ex- 48113)"""
+        return '{:05d}'.format(int(self.fips[index]))
+
+    def name(self, index):
+        """Returns the name of a county (Ex- Dallas County, TX)"""
+        return str(self.names[index])
+
+    def neighbors(self, index):
+        """Returns the array of neighbor indices of a county"""
+        return self.indices[self.indptr[index]:self.indptr[index + 1]]
+
+
+_adjacency = None
+_adjacency_lock = threading.Lock()
+
+
+def load_adjacency(path=ADJACENCY_PATH):
+    """Returns the process-wide adjacency graph, loading it on first call
+
+    The graph is loaded from the bundled file only, never downloaded at
+    runtime: if the file is missing, counties have no neighbors until
+    it is built with python adjacency.py.
+    """
+    global _adjacency
+    if _adjacency is None:
+        with _adjacency_lock:
+            if _adjacency is None:
+                if os.path.exists(path):
+                    _adjacency = CountyAdjacency.load(path)
+                else:
+                    logger.error('%s not found, run python adjacency.py to build it', path)
+                    _adjacency = CountyAdjacency(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=str),
+                                                 np.zeros(1, dtype=np.int32), np.zeros(0, dtype=np.int32))
+    return _adjacency
+
+
+def build(source=COUNTY_ADJACENCY_URL, path=ADJACENCY_PATH):
+    """Builds and saves the graph from a census file path or URL"""
+    if source.startswith(('http://', 'https://')):
+        response = requests.get(source, timeout=30)
+        response.raise_for_status()
+        content = response.content
+    else:
+        with open(source, 'rb') as f:
+            content = f.read()
+    # Recent census files are UTF-8, the 2010 one is Latin-1
+    try:
+        text = content.decode('utf-8')
+    except UnicodeDecodeError:
+        text = content.decode('latin-1')
+    adjacency = CountyAdjacency.from_census_text(text)
+    try:
+        adjacency.save(path)
+    except OSError:
+        logger.exception('Failed to save the adjacency graph to %s', path)
+    return adjacency
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3:
+        sys.exit('usage: python adjacency.py [county_adjacency.txt] [county_adjacency.npz]')
+    adjacency = build(*sys.argv[1:])
+    print('{} counties, {} adjacencies'.format(len(adjacency), len(adjacency.indices)))
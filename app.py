@@ -1,53 +1,187 @@
-import codecs
-import csv
+import logging
 import os
-import sched
 import threading
-import time
-import urllib
 
-from flask import Flask, render_template, request
+from adjacency import load_adjacency
+
+from county_data import STATE_NAMES, county_store
+
+from dedup import event_dedup, event_key
+
+from dispatch import QueueFull, dispatcher
+
+from flask import Flask, Response, jsonify, render_template, request
 
 from flask_classful import FlaskView, route
 
+from geocode import extract_location, geocode_cache
+
 import googlemaps
 
-from helpers import create_county_adjacency_dict, \
-    create_quick_reply_button, send_follow_up_message, \
-    send_message, send_notification_request, send_start_options, \
-    set_get_started_button_payload, set_greeting_text
+from helpers import create_follow_up_message, create_notification_request, \
+    create_quick_reply_button, create_url_button, send_message, \
+    send_notification_request, send_start_options, setup_page
+
+from messenger import SendError, button_template, send_client
+
+from metrics import registry, timed, traced
+
+from ranking import load_ranker
 
-from pymessenger2.bot import Bot
-from pymessenger2.buttons import URLButton
+from resolver import load_resolver
 
-import requests
+from risk import grid_hour, load_risk_index
+
+from sessions import create_session_store
+
+from subscriptions import SubscriptionScheduler
+
+from upstream import search_places, state_covid_site, upstream_cache
 
 app = Flask(__name__)
-ACCESS_TOKEN = os.environ.get('ACCESS_TOKEN')
 VERIFY_TOKEN = os.environ.get('VERIFY_TOKEN')
 MAPS_API_TOKEN = os.environ.get('MAPS_API_TOKEN')
-COUNTY_DATA_URL = 'https://raw.githubusercontent.com/' \
-    'nytimes/covid-19-data/master/us-counties.csv'
-bot = Bot(ACCESS_TOKEN)
+MAPS_API_URL = os.environ.get('MAPS_API_URL', 'https://maps.googleapis.com')
+DEST_TYPE_ICONS = {'Grocery': u'\U0001F6D2', 'Pharmacy': u'\U0001F48A',
+                   'Hospital': u'\U0001F3E5'}
+# Conversation step of each quick reply, a newer reply of a step
+# supersedes the queued ones of the same sender
+QUICK_REPLY_STEPS = {'GROCERY': 'dest_type', 'PHARMACY': 'dest_type', 'HOSPITAL': 'dest_type',
+                     'OTHER': 'dest_type', 'SEARCH_ORIG_COUNTY': 'search_county',
+                     'SEARCH_SAFER_COUNTY': 'search_county', 'SEARCH_YES': 'search_again',
+                     'SEARCH_NO': 'search_again'}
+sessions = create_session_store()
+_maps_client = None
+_maps_client_lock = threading.Lock()
+_warmed_up = threading.Event()
+
+logger = logging.getLogger(__name__)
+
+
+def load_maps_client():
+    """Returns the process-wide Googlemaps client, created on first call"""
+    global _maps_client
+    if _maps_client is None:
+        with _maps_client_lock:
+            if _maps_client is None:
+                _maps_client = googlemaps.Client(key=MAPS_API_TOKEN, base_url=MAPS_API_URL)
+    return _maps_client
+
+
+def warm_up():
+    """Loads the read-only data every request uses
+
+    Nothing is loaded at import. Under gunicorn's preload_app this runs
+    once in the master (wsgi.py), so the forked workers share the data
+    copy-on-write. It starts no thread, threads don't survive a fork:
+    each serving process calls start_background() instead.
+
+    The snapshot left by the previous run is opened before the first
+    refresh, so the refresh is compared with it and the changes published
+    while the bot was down are notified too.
+    """
+    with timed('warm_up'):
+        load_adjacency()
+        load_ranker()
+        load_resolver()
+        load_risk_index()
+        load_maps_client()
+        county_store.open_snapshot()
+        if not county_store.loaded:
+            county_store.refresh()
+    _warmed_up.set()
+
+
+def start_background():
+    """Starts the county data refreshes and the subscription scheduler
+
+    Only one serving process refreshes the county data, the others map
+    the snapshots it writes. The subscribers of the counties whose
+    numbers moved are notified after each refresh.
+    """
+    county_store.start()
+    subscription_scheduler.start()
+
+
+def readiness():
+    """Tells whether the shared data is loaded
+
+    :returns: dict with warmed_up, county_data and ready (both)
+    """
+    status = {'warmed_up': _warmed_up.is_set(), 'county_data': county_store.loaded}
+    status['ready'] = all(status.values())
+    return status
+
+
+def event_tag(message):
+    """Tags a messaging event to coalesce a burst of its sender
+
+    :param message: an entry.messaging item of the webhook payload
+    :returns: (kind, value) tag, None for events never coalesced
+        (Ex- optins, each carrying its own notification token), or False
+        for events with nothing to act on (Ex- deliveries, reads)
+    """
+    if message.get('postback'):
+        return ('postback', message['postback'].get('payload'))
+    if message.get('optin'):
+        return None
+    event = message.get('message')
+    if not event or event.get('is_echo'):
+        return False
+    if event.get('quick_reply'):
+        payload = event['quick_reply'].get('payload')
+        return (QUICK_REPLY_STEPS.get(payload, payload), payload)
+    for attachment in event.get('attachments', []):
+        if attachment.get('type') == 'location':
+            coordinates = attachment['payload']['coordinates']
+            return ('search', (coordinates['lat'], coordinates['long']))
+    if event.get('text'):
+        return ('search', event['text'].strip().lower())
+    return False
 
 
 class App(FlaskView):
     def __init__(self):
-        """Intializes a new instance with following:
-        Googlemaps client, US County Adjacency dict and
-        Scheduler object
+        """Intializes a new instance, one per request, sharing the
+        process-wide Googlemaps client, US County Adjacency graph,
+        safer county ranker, offline county resolver and risk grids,
+        each loaded on first use unless warm_up() loaded them already
         """
-        self.map_connect = googlemaps.Client(key=MAPS_API_TOKEN)
-        self.county_adjacency = create_county_adjacency_dict()
-        self.scheduler = sched.scheduler(time.time, time.sleep)
-        self.thread = None
-        self.user_data = {}
         self.cache = {}
 
+    @property
+    def map_connect(self):
+        return load_maps_client()
+
+    @property
+    def county_adjacency(self):
+        return load_adjacency()
+
+    @property
+    def ranker(self):
+        return load_ranker()
+
+    @property
+    def resolver(self):
+        return load_resolver()
+
+    @property
+    def risk_index(self):
+        return load_risk_index()
+
     @route("/")
     def index(self):
         return render_template("index.html")
 
+    @route("/ready")
+    def ready(self):
+        status = readiness()
+        return jsonify(status), 200 if status['ready'] else 503
+
+    @route("/metrics")
+    def metrics(self):
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
     @route("/webhook", methods=['GET', 'POST'])
     def start(self):
         # Actions when GET requests are received
@@ -57,190 +191,295 @@ class App(FlaskView):
             else:
                 return 'Invalid verification token'
         # Actions when POST requests are received
-        else:
-            output = request.get_json()
-            for event in output['entry']:
-                messaging = event['messaging']
-                for message in messaging:
-                    # Used when payload is received from a postback button
-                    if message.get('postback'):
-                        payload = message['postback']['payload']
-                        if payload == 'GET_STARTED':
-                            set_greeting_text('Hi {{user_first_name}}!')
-                            set_get_started_button_payload()
-                            # Store the sender id to send response back to
-                            recipient_id = message['sender']['id']
-                            if recipient_id not in self.user_data.keys():
-                                self.user_data[recipient_id] = {}
-                            bot.send_action(recipient_id, 'typing_on')
-                            send_message(recipient_id, 'Welcome to En route to safety! (USA only)')
-                            time.sleep(2)
-                            # Send quick reply options Grocery, Pharmacy,
-                            # Hospital or Other to the user
-                            send_start_options(recipient_id)
-
-                    # Used when a user subscribes to one time notif
-                    if message.get('optin'):
-                        payload = message['optin']['payload']
-                        if payload == 'SUBSCRIBE_USER':
-                            token = message['optin']['one_time_notif_token']
-                            recipient_id = message['sender']['id']
-                            # Initialize a thread if it doesn't exist
-                            if not self.thread:
-                                self.thread = threading.Thread(target=self.subscriber_queue, args=(recipient_id, token,))
-                                self.thread.start()
-                            # If the thread exists, check if its still alive
-                            else:
-                                # If thread is not alive, initialize it
-                                if not self.thread.is_alive():
-                                    self.thread = threading.Thread(target=self.subscriber_queue, args=(recipient_id, token,))
-                                    self.thread.start()
-                                else:
-                                    # The thread exists, add the notif request to the scheduler queue
-                                    # such that it sends the notification after 24 hours and 1 minute
-                                    self.scheduler.enter(86460, 1, self.send_one_time_notification, (recipient_id, token,))
-                            send_message(recipient_id, 'Thanks! You are now subscribed to daily cases updates of {}. According to Facebook\'s Privacy Policy, you need to subscribe every 24 hours to keep receiving updates'.format(self.user_data[recipient_id]['subscribe_county']))
-
-                    if message.get('message'):
-                        recipient_id = message['sender']['id']
-                        # Create the user entry in self.user_data dict if
-                        # it doesn't exist already
-                        if recipient_id not in self.user_data.keys():
-                            self.user_data[recipient_id] = {}
-                        qr = message['message'].get('quick_reply')
-                        txt = message['message'].get('text')
-
-                        # Used when the message is a quick reply
-                        if qr and txt:
-                            payload = message['message']['quick_reply']['payload']
-                            # Set destination type and icon based on user selection
-                            if (payload == 'GROCERY' or payload == 'PHARMACY' or payload == 'HOSPITAL' or payload == 'OTHER'):
-                                if payload == 'GROCERY':
-                                    self.user_data[recipient_id]['dest_type'] = "Grocery"
-                                    self.user_data[recipient_id]['dest_type_icon'] = u'\U0001F6D2'
-
-                                if payload == 'PHARMACY':
-                                    self.user_data[recipient_id]['dest_type'] = "Pharmacy"
-                                    self.user_data[recipient_id]['dest_type_icon'] = u'\U0001F48A'
-
-                                if payload == 'HOSPITAL':
-                                    self.user_data[recipient_id]['dest_type'] = "Hospital"
-                                    self.user_data[recipient_id]['dest_type_icon'] = u'\U0001F3E5'
-
-                                if payload == 'OTHER':
-                                    self.user_data[recipient_id]['dest_type'] = None
-                                send_message(recipient_id, 'Thanks, please enter the destination location now')
-
-                            # Set search county based on user input
-                            if (payload == 'SEARCH_ORIG_COUNTY' or payload == 'SEARCH_SAFER_COUNTY'):
-                                try:
-                                    if payload == 'SEARCH_ORIG_COUNTY':
-                                        search_county = self.user_data[recipient_id]['orig_county'] + ', ' + self.user_data[recipient_id]['state_short']
-                                    else:
-                                        search_county = self.user_data[recipient_id]['safer_county']
-                                    self.user_data[recipient_id]['subscribe_county'] = search_county
-                                    # Send a Google Maps url to the user based on previous inputs
-                                    if self.user_data[recipient_id].get('dest_type'):
-                                        dest_type = self.user_data[recipient_id]['dest_type']
-                                        # Seach for currently open businesses of the user specified type
-                                        search_url = "https://maps.googleapis.com/maps/api/place/textsearch/json?"
-                                        places_search = requests.get(
-                                            search_url + 'query=' + dest_type + '+' + '+'.join(str(search_county).split()) + '&opennow=true&key=' + MAPS_API_TOKEN)
-                                        places_list = places_search.json()['results']
-                                        buttons = []
-                                        # Provide upto 2 results as max limit is 3 for URL buttons
-                                        result_number = 2 if len(places_list) > 2 else len(places_list)
-                                        for number in range(result_number):
-                                            place_address = places_list[number]['formatted_address']
-                                            place_url = 'https://www.google.com/maps/place/' + '+'.join(place_address.split())
-                                            buttons.append(URLButton(title=places_list[number]['name'], url=place_url))
-                                        # Third button will provide a list of all available options
-                                        buttons.append(URLButton(title=self.user_data[recipient_id]['dest_type_icon'] + ' ' + dest_type + ' (All Options)',
-                                                                 url="https://maps.google.com/?q={}".format(dest_type + '+' + '+'.join(str(search_county).split()))))
-                                        bot.send_button_message(recipient_id, "Click below to search for {} options in {}".format(dest_type, search_county), buttons)
-                                    else:
-                                        buttons = []
-                                        buttons.append(URLButton(title=search_county,
-                                                                 url="https://maps.google.com/?q={}".format('+'.join(str(search_county).split()))))
-                                        bot.send_button_message(recipient_id, "Click below to search within {}".format(search_county), buttons)
-                                except KeyError:
-                                    send_message(recipient_id, "Oops, error occured..")
-                                finally:
-                                    # Ask if the user wants to search for another location
-                                    buttons = []
-                                    button = create_quick_reply_button('text', 'Yes', 'SEARCH_YES')
-                                    buttons.append(button)
-                                    button = create_quick_reply_button('text', 'No', 'SEARCH_NO')
-                                    buttons.append(button)
-                                    time.sleep(5)
-                                    bot.send_quick_reply(recipient_id, 'Do you want to search for another place?', buttons)
-
-                            if payload == 'SEARCH_YES':
-                                send_start_options(recipient_id)
-
-                            if payload == 'SEARCH_NO':
-                                # Send subscribe option to user
-                                if self.user_data[recipient_id].get('subscribe_county'):
-                                    send_message(recipient_id, 'Click \'Notify Me\' to subscribe for updates')
-                                    send_notification_request(recipient_id, self.user_data[recipient_id]['subscribe_county'], 'SUBSCRIBE_USER')
-                                send_message(recipient_id, 'Message \'Start\' anytime to get searching again')
-                                time.sleep(2)
-                                send_message(recipient_id, 'Thank you, visit again!')
-
-                        # Used when the message is a text
-                        if txt and not qr:
-                            address = message['message']['text']
-                            if address.lower() == 'start':
-                                send_start_options(recipient_id)
-                                continue
-                            bot.send_action(recipient_id, 'mark_seen')
-                            time.sleep(2)
-                            send_message(recipient_id, "Searching...")
-                            bot.send_action(recipient_id, 'typing_on')
-                            result_list = self._search_address(address)
-                            if result_list:
-                                self.user_data[recipient_id]['orig_county'] = result_list[0]
-                                self.user_data[recipient_id]['state'] = state = result_list[1]
-                                self.user_data[recipient_id]['state_short'] = result_list[2]
-                                cases = result_list[3]
-                                deaths = result_list[4]
-                                date_updated = result_list[5]
-                                self.user_data[recipient_id]['safer_county'] = result_list[6]
-                                safer_county_cases = result_list[7]
-                            else:
-                                send_message(recipient_id, "Invalid address, try again")
-                                break
-
-                            try:
-                                if cases:
-                                    # Send total cases, deaths and date updated of the county from user input
-                                    send_message(recipient_id, self.user_data[recipient_id]['orig_county'] + ", " + state)
-                                    send_message(recipient_id, "Total positive cases: {}, Deaths: {} as of {}".
-                                                 format(cases, deaths, date_updated))
-                                    time.sleep(2)
-                                    # Send the safest adjacent county found to the user input county with its cases
-                                    send_message(recipient_id, "A safer nearby county we've found is {} with {} cases".
-                                                 format(self.user_data[recipient_id]['safer_county'], safer_county_cases))
-                                    # Ask which county does user want to search in
-                                    buttons = []
-                                    button = create_quick_reply_button('text', self.user_data[recipient_id]['orig_county'] + ', ' + self.user_data[recipient_id]['state_short'], 'SEARCH_ORIG_COUNTY')
-                                    buttons.append(button)
-                                    button = create_quick_reply_button('text', self.user_data[recipient_id]['safer_county'], 'SEARCH_SAFER_COUNTY')
-                                    buttons.append(button)
-                                    bot.send_quick_reply(recipient_id, "Which county do you want to search in?", buttons)
-
-                            except UnboundLocalError:
-                                send_message(recipient_id, "Sorry no data found")
-                                break
+        with timed('webhook'):
+            return self._accept_events(request.get_json())
+
+    def _accept_events(self, output):
+        """Queues the events of a webhook POST body on the dispatcher
 
+        :param output: decoded webhook payload
+        :returns: Flask response
+        """
+        calls = []
+        tags = []
+        keys = []
+        for event in output['entry']:
+            for message in event.get('messaging', []):
+                recipient_id = message.get('sender', {}).get('id')
+                tag = event_tag(message)
+                if not recipient_id or tag is False:
+                    continue
+                # Drop events of a batch delivered again
+                key = event_key(message)
+                if key is not None:
+                    if not event_dedup.claim(key):
+                        continue
+                    keys.append(key)
+                calls.append((recipient_id, self._handle_event, message))
+                tags.append(tag)
+        try:
+            dispatcher.submit_many(calls, tags)
+        except QueueFull:
+            # Messenger delivers the batch again later
+            event_dedup.release(keys)
+            return "Busy", 503
         return "Success"
 
+    def _handle_event(self, message):
+        """Handles one messaging event of the webhook on a dispatcher worker
+
+        Yields the number of seconds to wait before the next send, so
+        the worker can serve other users meanwhile.
+
+        :param message: an entry.messaging item of the webhook payload
+        """
+        recipient_id = message['sender']['id']
+        user = sessions.get(recipient_id)
+        try:
+            yield from traced(self._handle_user_event(message, user), 'Event {}'.format(event_key(message)))
+        finally:
+            sessions.save(recipient_id, user)
+
+    def _handle_user_event(self, message, user):
+        """Handles a messaging event with the conversation state of its sender
+
+        :param message: an entry.messaging item of the webhook payload
+        :param user: sessions.SessionRecord of the sender, updated in place
+        """
+        # Used when payload is received from a postback button
+        if message.get('postback'):
+            payload = message['postback']['payload']
+            if payload == 'GET_STARTED':
+                # Store the sender id to send response back to
+                recipient_id = message['sender']['id']
+                send_client.send_action(recipient_id, 'typing_on')
+                send_message(recipient_id, 'Welcome to En route to safety! (USA only)')
+                yield 2
+                # Send quick reply options Grocery, Pharmacy,
+                # Hospital or Other to the user
+                send_start_options(recipient_id)
+
+        # Used when a user subscribes to one time notif
+        if message.get('optin'):
+            payload = message['optin']['payload']
+            if payload == 'SUBSCRIBE_USER':
+                token = message['optin']['one_time_notif_token']
+                recipient_id = message['sender']['id']
+                subscription_scheduler.subscribe(recipient_id, token,
+                                                 user['subscribe_county'],
+                                                 user.get('state_short'))
+                send_message(recipient_id, 'Thanks! You are now subscribed to daily cases updates of {}. According to Facebook\'s Privacy Policy, you need to subscribe every 24 hours to keep receiving updates'.format(user['subscribe_county']))
+
+        if message.get('message'):
+            recipient_id = message['sender']['id']
+            qr = message['message'].get('quick_reply')
+            txt = message['message'].get('text')
+
+            # Used when the message is a quick reply
+            if qr and txt:
+                payload = message['message']['quick_reply']['payload']
+                # Set destination type and icon based on user selection
+                if (payload == 'GROCERY' or payload == 'PHARMACY' or payload == 'HOSPITAL' or payload == 'OTHER'):
+                    if payload == 'GROCERY':
+                        user['dest_type'] = "Grocery"
+
+                    if payload == 'PHARMACY':
+                        user['dest_type'] = "Pharmacy"
+
+                    if payload == 'HOSPITAL':
+                        user['dest_type'] = "Hospital"
+
+                    if payload == 'OTHER':
+                        user['dest_type'] = None
+                    send_message(recipient_id, 'Thanks, please enter the destination location now')
+
+                # Set search county based on user input
+                if (payload == 'SEARCH_ORIG_COUNTY' or payload == 'SEARCH_SAFER_COUNTY'):
+                    try:
+                        if payload == 'SEARCH_ORIG_COUNTY':
+                            search_county = user['orig_county'] + ', ' + user['state_short']
+                        else:
+                            search_county = user['safer_county']
+                        user['subscribe_county'] = search_county
+                        # Send a Google Maps url to the user based on previous inputs
+                        if user.get('dest_type'):
+                            dest_type = user['dest_type']
+                            # Seach for currently open businesses of the user specified type
+                            places_list = search_places(dest_type, search_county)
+                            buttons = []
+                            # Provide upto 2 results as max limit is 3 for URL buttons
+                            result_number = 2 if len(places_list) > 2 else len(places_list)
+                            for number in range(result_number):
+                                place_address = places_list[number]['formatted_address']
+                                place_url = 'https://www.google.com/maps/place/' + '+'.join(place_address.split())
+                                buttons.append(create_url_button(title=places_list[number]['name'], url=place_url))
+                            # Third button will provide a list of all available options
+                            buttons.append(create_url_button(title=DEST_TYPE_ICONS[dest_type] + ' ' + dest_type + ' (All Options)',
+                                                             url="https://maps.google.com/?q={}".format(dest_type + '+' + '+'.join(str(search_county).split()))))
+                            send_client.send_button_message(recipient_id, "Click below to search for {} options in {}".format(dest_type, search_county), buttons)
+                        else:
+                            buttons = []
+                            buttons.append(create_url_button(title=search_county,
+                                                             url="https://maps.google.com/?q={}".format('+'.join(str(search_county).split()))))
+                            send_client.send_button_message(recipient_id, "Click below to search within {}".format(search_county), buttons)
+                    except KeyError:
+                        send_message(recipient_id, "Oops, error occured..")
+                    finally:
+                        # Ask if the user wants to search for another location
+                        buttons = []
+                        button = create_quick_reply_button('text', 'Yes', 'SEARCH_YES')
+                        buttons.append(button)
+                        button = create_quick_reply_button('text', 'No', 'SEARCH_NO')
+                        buttons.append(button)
+                        yield 5
+                        send_client.send_quick_reply(recipient_id, 'Do you want to search for another place?', buttons)
+
+                if payload == 'SEARCH_YES':
+                    send_start_options(recipient_id)
+
+                if payload == 'SEARCH_NO':
+                    # Send subscribe option to user
+                    if user.get('subscribe_county'):
+                        send_message(recipient_id, 'Click \'Notify Me\' to subscribe for updates')
+                        send_notification_request(recipient_id, user['subscribe_county'], 'SUBSCRIBE_USER')
+                    send_message(recipient_id, 'Message \'Start\' anytime to get searching again')
+                    yield 2
+                    send_message(recipient_id, 'Thank you, visit again!')
+
+            # Used when the message is a location pin
+            coordinates = None
+            for attachment in message['message'].get('attachments', []):
+                if attachment.get('type') == 'location':
+                    coordinates = attachment['payload']['coordinates']
+
+            # Used when the message is a text or a location pin
+            if (txt and not qr) or coordinates:
+                if txt and txt.lower() == 'start':
+                    send_start_options(recipient_id)
+                    return
+                send_client.send_action(recipient_id, 'mark_seen')
+                yield 2
+                send_message(recipient_id, "Searching...")
+                send_client.send_action(recipient_id, 'typing_on')
+                if coordinates:
+                    risk_report = self._risk_report(coordinates['lat'], coordinates['long'])
+                    if risk_report:
+                        send_message(recipient_id, risk_report)
+                    result_list = self._search_location(coordinates['lat'], coordinates['long'])
+                else:
+                    result_list = self._search_address(txt)
+                if result_list:
+                    user['orig_county'] = result_list[0]
+                    user['state'] = state = result_list[1]
+                    user['state_short'] = result_list[2]
+                    cases = result_list[3]
+                    deaths = result_list[4]
+                    date_updated = result_list[5]
+                    user['safer_county'] = result_list[6]
+                    safer_county_cases = result_list[7]
+                    trend = county_store.trend(result_list[8])
+                else:
+                    send_message(recipient_id, "Invalid address, try again")
+                    return
+
+                try:
+                    if cases is not None:
+                        # Send total cases, deaths and date updated of the county from user input
+                        send_message(recipient_id, user['orig_county'] + ", " + state)
+                        send_message(recipient_id, "Total positive cases: {}, Deaths: {} as of {}".
+                                     format(cases, deaths, date_updated))
+                        if trend:
+                            new_cases, growth_rate = trend
+                            if growth_rate is None:
+                                send_message(recipient_id, "New cases in the last 7 days: {}".format(new_cases))
+                            else:
+                                send_message(recipient_id, "New cases in the last 7 days: {} ({:+.1%})".
+                                             format(new_cases, growth_rate))
+                        yield 2
+                        buttons = []
+                        button = create_quick_reply_button('text', user['orig_county'] + ', ' + user['state_short'], 'SEARCH_ORIG_COUNTY')
+                        buttons.append(button)
+                        # No safer county when no neighbor is ranked yet
+                        if user['safer_county']:
+                            # Send the safest adjacent county found to the user input county with its cases
+                            send_message(recipient_id, "A safer nearby county we've found is {} with {} cases".
+                                         format(user['safer_county'], safer_county_cases))
+                            button = create_quick_reply_button('text', user['safer_county'], 'SEARCH_SAFER_COUNTY')
+                            buttons.append(button)
+                        # Ask which county does user want to search in
+                        send_client.send_quick_reply(recipient_id, "Which county do you want to search in?", buttons)
+
+                except UnboundLocalError:
+                    send_message(recipient_id, "Sorry no data found")
+                    return
+
     def _search_address(self, address):
         """Search the address from the given user input
 
+        ZIP codes are resolved offline, other addresses are geocoded.
+
         :param address: The user input address to search for
-        :returns: a list of following values in specified order
-            county: search result county name (Ex- Dallas County, TX)
+        :returns: the list returned by _county_report or None
+        """
+        try:
+            with timed('resolve_offline'):
+                fips = self.resolver.resolve_address(address)
+            if fips is not None:
+                return self._county_report(self.county_adjacency.index_of_fips(fips))
+            location = geocode_cache.resolve(address, self.map_connect)
+            if location is None:
+                return None
+            return self._county_report(self.county_adjacency.index_of_name(location.county + ", " + location.state_short))
+        except Exception:
+            return None
+
+    def _search_location(self, lat, lng):
+        """Search the county of a location pin sent by the user
+
+        :param lat: latitude of the location
+        :param lng: longitude of the location
+        :returns: the list returned by _county_report or None
+        """
+        try:
+            with timed('resolve_offline'):
+                fips = self.resolver.resolve_point(lat, lng)
+            if fips is None:
+                with timed('reverse_geocode'):
+                    results = self.map_connect.reverse_geocode((lat, lng))
+                if not results:
+                    return None
+                location = extract_location(results[0])
+                return self._county_report(self.county_adjacency.index_of_name(location.county + ", " + location.state_short))
+            return self._county_report(self.county_adjacency.index_of_fips(fips))
+        except Exception:
+            return None
+
+    def _risk_report(self, lat, lng):
+        """Describes the risk right now at a location pin sent by the user
+
+        :param lat: latitude of the location
+        :param lng: longitude of the location
+        :returns: message text or None if the location is outside the risk grids
+        """
+        hour = grid_hour()
+        with timed('risk_lookup'):
+            cell = self.risk_index.risk_at(lat, lng, hour)
+            nearby = self.risk_index.lowest_risk_nearby(lat, lng, hour, limit=1) if cell else None
+        if cell is None:
+            return None
+        report = "Risk right now at this spot: {:.0%} ({} reports)".format(cell.risk, cell.num)
+        if nearby and nearby[0][0].risk < cell.risk:
+            safer_cell, distance = nearby[0]
+            report += ", {:.0%} about {:.1f} km away".format(safer_cell.risk, distance)
+        return report
+
+    def _county_report(self, index):
+        """Collects the numbers of a county and its safer neighbor
+
+        :param index: county index in the adjacency graph
+        :returns: a list of following values in specified order, or None
+            if the county is unknown
+            county: search result county name (Ex- Dallas County)
             state: search result state name in long format (Ex- Texas)
             state_short: search result state name in short (Ex- TX)
             cases: search result number of cases (Ex- 4324)
@@ -249,86 +488,118 @@ class App(FlaskView):
             safer_county: safer county name from adjacent search result
                 counties (Ex- Rockwall County, TX)
             safer_county_cases: safer county number of cases (Ex- 1234)
+            fips: search result county FIPS code (Ex- 48113)
         """
-        try:
-            result = self.map_connect.geocode(address)[0]
-            state = state_short = county = safer_county = ""
-            counties = {}
-            for element in result['address_components']:
-                for key, value in element.items():
-                    if (key == 'types' and 'administrative_area_level_1' in value):
-                        state_short = element['short_name']
-                        state = element['long_name']
-            for element in result['address_components']:
-                for key, value in element.items():
-                    if (key == 'types' and 'administrative_area_level_2' in value):
-                        county = element['short_name']
-                        response = urllib.request.urlopen(COUNTY_DATA_URL)
-                        csv_reader = csv.reader(codecs.iterdecode(response, 'utf-8'))
-                        for row in csv_reader:
-                            if (row[2].lower() == state.lower() and state):
-                                if row[1].lower() in county.lower():
-                                    date_updated = row[0]
-                                    cases = row[4]
-                                    deaths = row[5]
-            for county_result in self.county_adjacency[county + ", " + state_short]:
-                response = urllib.request.urlopen(COUNTY_DATA_URL)
-                csv_reader = csv.reader(codecs.iterdecode(response, 'utf-8'))
-                for row in csv_reader:
-                    if (row[2].lower() == state.lower() and state):
-                        if row[1].lower() in county_result.lower():
-                            counties[county_result] = int(row[4])
-            if counties:
-                safer_county = min(counties, key=counties.get)
-                safer_county_cases = counties[safer_county]
-
-            return [county, state, state_short, cases, deaths, date_updated, safer_county, safer_county_cases]
-        except Exception:
+        if index is None:
             return None
-
-    def send_one_time_notification(self, recipient_id, token):
-        """Sends one time notification to the subscribed user
-
-        :param recipient_id: user id key to search stored values
-            from user_data dict
-        :param token: one time notif token issues when user subscribed
-        :returns: None
-        """
-        subscriber_county_cases = None
-        search_state = self.user_data[recipient_id]['state']
-        county_name = str(self.user_data[recipient_id]['subscribe_county']).split()[0]
-        response = urllib.request.urlopen(COUNTY_DATA_URL)
-        csv_reader = csv.reader(codecs.iterdecode(response, 'utf-8'))
-        for row in csv_reader:
-            if row[2].lower() == search_state.lower():
-                if county_name.lower() == row[1].lower():
-                    subscriber_county_cases = row[4]
-        if self.user_data[recipient_id].get('subscribe_county') and subscriber_county_cases:
-            send_follow_up_message(token, "Number of total cases for {} are {}".format(self.user_data[recipient_id]['subscribe_county'], subscriber_county_cases))
-        if self.user_data[recipient_id].get('state_short'):
-            state_metadata_url = "https://covidtracking.com/api/v1/states/{}/info.json".format(self.user_data[recipient_id]['state_short'].lower())
-            state_metadata = requests.get(state_metadata_url)
-            if state_metadata.json()['covid19Site']:
+        county, _, state_short = self.county_adjacency.name(index).rpartition(', ')
+        state = STATE_NAMES.get(state_short, state_short)
+        safer_county = ""
+        safer_county_cases = None
+        with timed('county_lookup'):
+            record = county_store.lookup_fips(self.county_adjacency.fips_code(index))
+        if not record:
+            return None
+        with timed('safer_county'):
+            safer_index = self.ranker.safest(index)
+            if safer_index is not None:
+                safer_record = county_store.lookup_fips(self.county_adjacency.fips_code(safer_index))
+                if safer_record:
+                    safer_county = self.county_adjacency.name(safer_index)
+                    safer_county_cases = safer_record.cases
+
+        return [county, state, state_short, record.cases, record.deaths, record.date, safer_county, safer_county_cases, record.fips]
+
+
+def notify_subscribers(county, subscriptions):
+    """Sends the one time notification to the subscribers of a county
+
+    The county numbers and state metadata are fetched once for all of
+    them and the messages go out as batched sends.
+
+    Only the subscribers whose follow-up went through get the state
+    site and a new notification request.
+
+    :param county: subscribed county name (Ex- Dallas County, TX)
+    :param subscriptions: list of subscriptions.Subscription
+    :returns: list of the subscriptions notified, the others keep their
+        token for a later try
+    """
+    # By FIPS like the search, the NYT names don't always match the
+    # census ones (Ex- Doña Ana County)
+    index = load_adjacency().index_of_name(county)
+    record = None if index is None else county_store.lookup_fips(load_adjacency().fips_code(index))
+    if not record:
+        logger.warning('No numbers for %s, its %d subscribers are kept', county, len(subscriptions))
+        return []
+    content = "Number of total cases for {} are {}".format(county, record.cases)
+    results = send_client.send_batch([create_follow_up_message(subscription.token, content)
+                                      for subscription in subscriptions])
+    notified = [subscription for subscription, (_, result) in zip(subscriptions, results)
+                if not isinstance(result, SendError)]
+    # The tokens of the notified subscribers are used now, whatever
+    # happens to the follow-up sends below
+    try:
+        by_state = {}
+        for subscription in notified:
+            if subscription.state_short:
+                by_state.setdefault(subscription.state_short, []).append(subscription)
+        for state_short, state_subscriptions in by_state.items():
+            covid_site = state_covid_site(state_short)
+            if covid_site:
                 button = []
-                button.append(URLButton(title="Official {} COVID site".format(self.user_data[recipient_id]['state_short']), url=str(state_metadata.json()['covid19Site'])))
-                bot.send_button_message(recipient_id, 'Checkout the official state COVID info website', button)
-        send_notification_request(recipient_id, self.user_data[recipient_id]['subscribe_county'], 'SUBSCRIBE_USER')
-
-    def subscriber_queue(self, recipient_id, token):
-        """Schedules the subscriber for receiving updates
-
-        :param recipient_id: user id key to search stored values
-            from user_data dict
-        :param token: one time notif token issues when user subscribed
-        :returns: None
-        """
-        # send the notification after 24 hours and 1 minute
-        self.scheduler.enter(86460, 1, self.send_one_time_notification, (recipient_id, token,))
-        self.scheduler.run()
-
+                button.append(create_url_button(title="Official {} COVID site".format(state_short), url=str(covid_site)))
+                message = button_template('Checkout the official state COVID info website', button)
+                send_client.send_batch([{'recipient': {'id': subscription.recipient_id}, 'message': message}
+                                        for subscription in state_subscriptions])
+        message = create_notification_request(county, 'SUBSCRIBE_USER')
+        send_client.send_batch([{'recipient': {'id': subscription.recipient_id}, 'message': message}
+                                for subscription in notified])
+    except Exception:
+        logger.exception('Failed to send the follow-ups of the %s notification', county)
+    return notified
+
+
+def notify_changed_counties(fips):
+    """Queues the notifications of the counties whose numbers changed
+
+    :param fips: int32 array of the changed county FIPS codes
+    :returns: None
+    """
+    counties = load_adjacency().names_of_fips(fips)
+    registry.inc('covideye_counties_changed_total', len(counties),
+                 help='Counties whose numbers changed on a refresh')
+    subscription_scheduler.counties_changed(counties)
+
+
+subscription_scheduler = SubscriptionScheduler(notify_subscribers)
+county_store.add_change_listener(notify_changed_counties)
+
+registry.collect('covideye_events_pending', lambda: dispatcher.stats()['pending'],
+                 'Webhook events queued, not started')
+registry.collect('covideye_events_paused', lambda: dispatcher.stats()['paused'],
+                 'Webhook events waiting for a typing delay')
+registry.collect('covideye_events_coalesced_total', lambda: dispatcher.stats()['coalesced'],
+                 'Queued webhook events dropped for a newer one', 'counter')
+registry.collect('covideye_events_duplicate_total', lambda: event_dedup.stats()['dropped'],
+                 'Webhook events dropped as redelivered', 'counter')
+registry.collect('covideye_geocode_cache_hits_total', lambda: geocode_cache.stats()['hits'],
+                 'Addresses found in the geocode cache', 'counter')
+registry.collect('covideye_geocode_cache_misses_total', lambda: geocode_cache.stats()['misses'],
+                 'Addresses geocoded with the Maps API', 'counter')
+registry.collect('covideye_upstream_cache_hits_total',
+                 lambda: upstream_cache.counters['hits'] + upstream_cache.counters['stale_hits'],
+                 'Places and state info answers served from cache', 'counter')
+registry.collect('covideye_upstream_calls_total', lambda: upstream_cache.counters['upstream_calls'],
+                 'Places and state info calls made upstream', 'counter')
+registry.collect('covideye_subscriptions_active', subscription_scheduler.pending,
+                 'Subscriptions waiting for their notification')
 
 App.register(app, route_base="/")
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
+    warm_up()
+    setup_page()
+    start_background()
     app.run(host='0.0.0.0', port=port, debug=True)
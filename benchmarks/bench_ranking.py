@@ -0,0 +1,80 @@
+"""Times ranking the safest neighbor of ~3,200 synthetic counties
+
+Counties are laid out on a 64 x 50 grid, each adjacent to its 8
+surrounding cells, with 300 days of random cumulative cases.
+
+Run from the repository root: python benchmarks/bench_ranking.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from adjacency import CountyAdjacency  # noqa: E402
+from ranking import SaferCountyRanker  # noqa: E402
+
+ROWS = 64
+COLUMNS = 50
+DAYS = 300
+REPEAT = 20
+
+
+class SyntheticSnapshot(object):
+    def __init__(self, fips, days):
+        rng = np.random.default_rng(0)
+        self.fips = fips
+        self.dates = np.arange(days, dtype=np.int32)
+        daily = rng.poisson(rng.uniform(0, 50, len(fips)), (days, len(fips)))
+        self.cases = np.cumsum(daily, axis=0).astype(np.int32)
+
+
+def grid_adjacency(rows, columns):
+    n = rows * columns
+    neighbors = []
+    for i in range(n):
+        row, column = divmod(i, columns)
+        neighbors.append([r * columns + c
+                          for r in range(row - 1, row + 2)
+                          for c in range(column - 1, column + 2)
+                          if 0 <= r < rows and 0 <= c < columns and (r, c) != (row, column)])
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum([len(x) for x in neighbors], out=indptr[1:])
+    indices = np.array([j for x in neighbors for j in x], dtype=np.int32)
+    fips = np.arange(1000, 1000 + n, dtype=np.int32)
+    names = np.array(['County {}'.format(code) for code in fips])
+    return CountyAdjacency(fips, names, indptr, indices)
+
+
+def main():
+    adjacency = grid_adjacency(ROWS, COLUMNS)
+    population = np.random.default_rng(1).uniform(1000, 1000000, len(adjacency))
+    snapshot = SyntheticSnapshot(adjacency.fips, DAYS)
+
+    start = time.perf_counter()
+    ranker = SaferCountyRanker(adjacency, population)
+    setup = time.perf_counter() - start
+
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        ranker.rank(snapshot)
+        timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for index in range(len(adjacency)):
+        ranker.safest(index, 'per_capita', 2)
+    lookup = (time.perf_counter() - start) / len(adjacency)
+
+    print('counties: {}, 1-hop edges: {}, 2-hop edges: {}'.format(
+        len(adjacency), len(adjacency.indices), len(ranker.graphs[2][1])))
+    print('graph setup: {:.1f} ms'.format(setup * 1000))
+    print('rank all counties, all metrics and hops: median {:.1f} ms, max {:.1f} ms'.format(
+        np.median(timings) * 1000, max(timings) * 1000))
+    print('lookup: {:.2f} us'.format(lookup * 1e6))
+
+
+if __name__ == "__main__":
+    main()
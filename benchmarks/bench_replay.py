@@ -0,0 +1,392 @@
+"""Replays webhook conversations against the Flask app with fake upstreams
+
+Every upstream (Graph API, Maps geocode and Places, the NYT county CSV,
+the census adjacency file and covidtracking) is served by one local HTTP
+server with a configurable latency, over synthetic counties. The
+recorded conversation of payloads/conversation.json (GET_STARTED, a
+destination quick reply, a text address, SEARCH_ORIG_COUNTY, SEARCH_NO
+and an optin) is replayed for many synthetic users, with a share of the
+webhook batches delivered twice as Messenger does on slow answers.
+
+Reports webhook response latency, event completion latency (from the
+webhook POST to the end of the handler, typing delays scaled by
+--delay-scale), events/s, upstream calls per event and peak RSS, and
+writes them as JSON to compare commits.
+
+Run from the repository root:
+python benchmarks/bench_replay.py --users 200 --latency 20 --latency graph=50 --output replay.json
+"""
+import argparse
+import http.server
+import json
+import os
+import random
+import resource
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PAYLOADS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads', 'conversation.json')
+UPSTREAMS = ('graph', 'geocode', 'places', 'county_csv', 'adjacency', 'state_info')
+STATE = 'Texas'
+STATE_SHORT = 'TX'
+DAYS = 60
+
+
+def county_name(number):
+    return 'County{} County'.format(number)
+
+
+def county_fips(number):
+    return 48001 + 2 * number
+
+
+def county_csv(counties):
+    """NYT us-counties.csv rows of synthetic counties, sorted by date"""
+    rng = random.Random(16)
+    lines = ['date,county,state,fips,cases,deaths']
+    cases = [0] * counties
+    for day in range(DAYS):
+        date = time.strftime('%Y-%m-%d', time.gmtime(1583020800 + day * 86400))
+        for number in range(counties):
+            cases[number] += rng.randrange(20)
+            lines.append('{},County{},{},{},{},{}'.format(date, number, STATE, county_fips(number),
+                                                          cases[number], cases[number] // 50))
+    return '\n'.join(lines) + '\n'
+
+
+def adjacency_text(counties):
+    """county_adjacency.txt of synthetic counties on a 10 wide grid"""
+    lines = []
+    for number in range(counties):
+        neighbors = [number + delta for delta in (-10, -1, 1, 10)
+                     if 0 <= number + delta < counties and (abs(delta) == 10 or (number + delta) // 10 == number // 10)]
+        for position, neighbor in enumerate([number] + neighbors):
+            head = ('"{}, {}"\t{}'.format(county_name(number), STATE_SHORT, county_fips(number))
+                    if position == 0 else '\t')
+            lines.append('{}\t"{}, {}"\t{}'.format(head, county_name(neighbor), STATE_SHORT, county_fips(neighbor)))
+    return '\n'.join(lines) + '\n'
+
+
+class FakeUpstreams(http.server.ThreadingHTTPServer):
+    """Local stand-in for every upstream, counting calls per upstream
+
+    :param latencies: dict of upstream name to seconds added per call
+    :param counties: number of synthetic counties served
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latencies, counties):
+        super().__init__(('127.0.0.1', 0), FakeUpstreamHandler)
+        self.latencies = latencies
+        self.counts = dict.fromkeys(UPSTREAMS, 0)
+        self.lock = threading.Lock()
+        self.county_csv = county_csv(counties).encode()
+        self.adjacency_text = adjacency_text(counties).encode()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self, upstream):
+        with self.lock:
+            self.counts[upstream] += 1
+        time.sleep(self.latencies.get(upstream, 0))
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict.fromkeys(UPSTREAMS, 0)
+
+
+class FakeUpstreamHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body in one write, no delayed ACK stall on keep-alive
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, content_type='application/json', status=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/maps/api/geocode/json':
+            self.server.count('geocode')
+            number = ''.join(character for character in query.get('address', [''])[0] if character.isdigit())
+            county = county_name(int(number or 0))
+            self._reply({'status': 'OK', 'results': [{'address_components': [
+                {'long_name': county, 'short_name': county, 'types': ['administrative_area_level_2']},
+                {'long_name': STATE, 'short_name': STATE_SHORT, 'types': ['administrative_area_level_1']}]}]})
+        elif url.path == '/maps/api/place/textsearch/json':
+            self.server.count('places')
+            self._reply({'status': 'OK', 'results': [
+                {'name': 'Store {}'.format(number), 'formatted_address': '{} Main St, Dallas, TX'.format(number)}
+                for number in range(3)]})
+        elif url.path == '/us-counties.csv':
+            self.server.count('county_csv')
+            self._reply(self.server.county_csv, 'text/csv')
+        elif url.path == '/county_adjacency.txt':
+            self.server.count('adjacency')
+            self._reply(self.server.adjacency_text, 'text/plain')
+        elif url.path.startswith('/states/'):
+            self.server.count('state_info')
+            self._reply({'covid19Site': 'https://example.org/covid'})
+        else:
+            self._reply({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.count('graph')
+        if self.path.startswith('/v2.6/me/'):
+            self._reply({'recipient_id': '0', 'message_id': 'mid.fake', 'result': 'success'})
+        else:
+            # Graph batch request
+            batch = json.loads(urllib.parse.parse_qs(body.decode())['batch'][0])
+            self._reply([{'code': 200, 'body': '{}'} for _ in batch])
+
+
+def conversations(users, counties, first_user=1000000000000000, seed=16):
+    """Webhook bodies of the recorded conversation for synthetic users
+
+    :param first_user: sender id of the first user, the next ones follow
+    :returns: list of conversations, each a list of webhook bodies
+    """
+    with open(PAYLOADS_PATH) as f:
+        template = string.Template(f.read())
+    rng = random.Random(seed)
+    result = []
+    for number in range(users):
+        county = rng.randrange(counties)
+        text = template.substitute(user=first_user + number,
+                                   county='{}, {}'.format(county_name(county), STATE_SHORT),
+                                   address='County{} {}'.format(county, STATE_SHORT))
+        result.append(json.loads(text))
+    return result
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {'p{}'.format(p): round(values[min(int(len(values) * p / 100), len(values) - 1)] * 1e3, 3)
+            for p in (50, 95, 99)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_latencies(values):
+    """Parses --latency 20 --latency graph=50 into seconds per upstream"""
+    latencies = dict.fromkeys(UPSTREAMS, 0.0)
+    for value in values:
+        if '=' in value:
+            name, milliseconds = value.split('=', 1)
+            if name not in latencies:
+                raise SystemExit('Unknown upstream {}, one of {}'.format(name, ', '.join(UPSTREAMS)))
+            latencies[name] = float(milliseconds) / 1e3
+        else:
+            latencies = dict.fromkeys(UPSTREAMS, float(value) / 1e3)
+    return latencies
+
+
+def replay(args, latencies, upstreams, directory):
+    """Runs the warm-up and the replay, with the app's files in directory
+
+    :returns: dict of results
+    """
+    os.environ.update({
+        'ACCESS_TOKEN': 'benchmark', 'VERIFY_TOKEN': 'benchmark', 'MAPS_API_TOKEN': 'AIzaBenchmark',
+        'GRAPH_API_URL': upstreams.url + '/v2.6', 'MAPS_API_URL': upstreams.url,
+        'PLACES_SEARCH_URL': upstreams.url + '/maps/api/place/textsearch/json',
+        'STATE_INFO_URL': upstreams.url + '/states/{}/info.json',
+        'COUNTY_DATA_URL': upstreams.url + '/us-counties.csv',
+        'COUNTY_ADJACENCY_URL': upstreams.url + '/county_adjacency.txt',
+        'COUNTY_ADJACENCY_PATH': os.path.join(directory, 'county_adjacency.npz'),
+        'COUNTY_POPULATION_PATH': os.path.join(directory, 'county_population.csv'),
+        'COUNTY_SNAPSHOT_PATH': os.path.join(directory, 'county_snapshot.bin'),
+        'SUBSCRIPTIONS_DB': os.path.join(directory, 'subscriptions.db'),
+        'SESSIONS_DB': os.path.join(directory, 'sessions.db'),
+        'GEOCODE_DB': os.path.join(directory, 'geocode.db'),
+    })
+
+    import adjacency  # noqa: E402
+    adjacency.build(adjacency.COUNTY_ADJACENCY_URL, adjacency.ADJACENCY_PATH)
+    import app  # noqa: E402
+    app.warm_up()
+    from dedup import event_dedup  # noqa: E402
+    from dispatch import dispatcher  # noqa: E402
+
+    submitted = {}
+    completed = {}
+    handle_event = app.App._handle_event
+
+    def timed_handle_event(self, message):
+        key = (message['sender']['id'], message.get('timestamp'))
+        try:
+            for delay in handle_event(self, message):
+                yield delay * args.delay_scale
+        finally:
+            completed[key] = time.perf_counter()
+
+    app.App._handle_event = timed_handle_event
+
+    def post(client, body, timings):
+        data = json.dumps(body)
+        for entry in body['entry']:
+            for message in entry['messaging']:
+                submitted.setdefault((message['sender']['id'], message.get('timestamp')), time.perf_counter())
+        start = time.perf_counter()
+        response = client.post('/webhook', data=data, content_type='application/json')
+        timings.append(time.perf_counter() - start)
+        return response.status_code
+
+    def wait_idle(deadline):
+        while time.time() < deadline:
+            stats = dispatcher.stats()
+            if not stats['recipients'] and not stats['pending']:
+                return True
+            time.sleep(0.01)
+        return False
+
+    # Warm up: first App instance, adjacency, county CSV and ranker
+    client = app.app.test_client()
+    warmup = conversations(1, args.counties, first_user=2000000000000000)[0]
+    for body in warmup:
+        post(client, body, [])
+    wait_idle(time.time() + args.timeout)
+    warmup_calls = dict(upstreams.counts)
+    upstreams.reset()
+    submitted.clear()
+    completed.clear()
+    dedup_before = event_dedup.stats()
+    dispatch_before = dispatcher.stats()
+
+    # Interleave users step by step, as they would talk at once
+    users = conversations(args.users, args.counties)
+    rng = random.Random(17)
+    bodies = []
+    for step in range(max(len(user) for user in users)):
+        for user in users:
+            if step < len(user):
+                bodies.append(user[step])
+                if rng.random() < args.duplicate_rate:
+                    bodies.append(user[step])
+    events = sum(len(entry['messaging']) for body in bodies for entry in body['entry'])
+
+    timings = []
+    statuses = []
+    lock = threading.Lock()
+    position = [0]
+
+    def sender():
+        thread_client = app.app.test_client()
+        thread_timings = []
+        thread_statuses = []
+        while True:
+            with lock:
+                if position[0] >= len(bodies):
+                    break
+                body = bodies[position[0]]
+                position[0] += 1
+            # Messenger delivers a batch again after a 503
+            for attempt in range(20):
+                status = post(thread_client, body, thread_timings)
+                thread_statuses.append(status)
+                if status != 503:
+                    break
+                time.sleep(0.05 * (attempt + 1))
+        with lock:
+            timings.extend(thread_timings)
+            statuses.extend(thread_statuses)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=sender) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    posted = time.perf_counter() - start
+    idle = wait_idle(time.time() + args.timeout)
+    elapsed = time.perf_counter() - start
+
+    event_latencies = [completed[key] - submitted[key] for key in completed if key in submitted]
+    calls = dict(upstreams.counts)
+    dedup_stats = event_dedup.stats()
+    dispatch_stats = dispatcher.stats()
+    results = {
+        'commit': git_commit(),
+        'config': {'users': args.users, 'counties': args.counties, 'concurrency': args.concurrency,
+                   'latency_ms': {name: latency * 1e3 for name, latency in latencies.items()},
+                   'duplicate_rate': args.duplicate_rate, 'delay_scale': args.delay_scale},
+        'events': events,
+        'handled_events': len(event_latencies),
+        'dropped_duplicates': dedup_stats['dropped'] - dedup_before['dropped'],
+        'coalesced': dispatch_stats['coalesced'] - dispatch_before['coalesced'],
+        'busy_503': sum(1 for status in statuses if status == 503),
+        'non_2xx': sum(1 for status in statuses if status >= 300),
+        'drained': idle,
+        'webhook_ms': percentiles(timings),
+        'event_ms': percentiles(event_latencies),
+        'post_seconds': round(posted, 3),
+        'total_seconds': round(elapsed, 3),
+        'events_per_second': round(len(event_latencies) / elapsed, 1) if elapsed else None,
+        'upstream_calls': calls,
+        'upstream_calls_per_event': {name: round(count / max(len(event_latencies), 1), 3)
+                                     for name, count in calls.items()},
+        'warmup_upstream_calls': warmup_calls,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--counties', type=int, default=250)
+    parser.add_argument('--concurrency', type=int, default=8, help='threads posting webhooks')
+    parser.add_argument('--latency', action='append', default=[],
+                        help='milliseconds added by every upstream, or NAME=MS for one')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05,
+                        help='share of webhook batches delivered twice')
+    parser.add_argument('--delay-scale', type=float, default=0.0,
+                        help='scale of the typing delays handlers yield, 0 to skip them')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    latencies = parse_latencies(args.latency)
+    upstreams = FakeUpstreams(latencies, args.counties)
+    threading.Thread(target=upstreams.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory(prefix='bench-replay-') as directory:
+        results = replay(args, latencies, upstreams, directory)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Measures point queries over the hourly risk grids of mint_json
+
+Compares the GeoJSON grid index with the memory-mapped raster cube:
+load time and resident memory added by the load (each measured in a
+fresh process), then risk_at and lowest_risk_nearby rates for random
+points over the grid extent and for points at cell centers, since
+random points mostly miss the sparse grids. A linear scan of every
+cell of the hour is the baseline.
+
+Run from the repository root: python benchmarks/bench_risk.py [queries]
+"""
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from risk import HOURS, RiskCube, RiskIndex, convert  # noqa: E402
+from spatial import polygon_contains  # noqa: E402
+
+QUERIES = 100000
+
+
+def rss_mb():
+    """Current resident set size of this process"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+
+
+def measure_load(kind, path):
+    """Loads one format in this process and prints load ms and added RSS"""
+    before = rss_mb()
+    start = time.perf_counter()
+    index = RiskIndex.load() if kind == 'geojson' else RiskCube(path)
+    elapsed = time.perf_counter() - start
+    # Touch every hour, as the queries of a worker would over a day
+    for hour in range(HOURS):
+        index.risk_at(40.0, 116.4, hour)
+    print('{:.1f} {:.1f}'.format(elapsed * 1e3, rss_mb() - before))
+
+
+def linear_risk_at(index, lat, lng, hour):
+    grid = index.grids[hour]
+    for position, polygons in enumerate(grid.polygons):
+        if any(polygon_contains(polygon, lng, lat) for polygon in polygons):
+            return grid.items[position]
+    return None
+
+
+def rate(function, points):
+    start = time.perf_counter()
+    for lat, lng, hour in points:
+        function(lat, lng, hour)
+    elapsed = time.perf_counter() - start
+    return '{:.0f} queries/s ({:.1f} us/query)'.format(len(points) / elapsed, elapsed / len(points) * 1e6)
+
+
+def main():
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else QUERIES
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'risk_cube.bin')
+        start = time.perf_counter()
+        convert(path=path)
+        print('convert + round-trip check: {:.0f} ms, {:.2f} MB cube'.format(
+            (time.perf_counter() - start) * 1e3, os.path.getsize(path) / 1e6))
+        for kind in ('geojson', 'cube'):
+            output = subprocess.check_output([sys.executable, __file__, '--load', kind, path])
+            elapsed, rss = output.split()
+            print('{} load: {} ms, +{} MB RSS'.format(kind, elapsed.decode(), rss.decode()))
+
+        index = RiskIndex.load()
+        cube = RiskCube(path)
+        boxes = [box for grid in index.grids for box in grid.boxes]
+        min_x = min(box[0] for box in boxes)
+        min_y = min(box[1] for box in boxes)
+        max_x = max(box[2] for box in boxes)
+        max_y = max(box[3] for box in boxes)
+        rng = random.Random(13)
+        points = [(rng.uniform(min_y, max_y), rng.uniform(min_x, max_x), rng.randrange(HOURS))
+                  for _ in range(queries)]
+        cells = [(cell.lat, cell.lng, hour) for hour, grid in enumerate(index.grids) for cell in grid.items]
+        hits = [rng.choice(cells) for _ in range(queries)]
+
+        for name, source in (('geojson', index), ('cube', cube)):
+            print('{} risk_at: {} random, {} on cells'.format(
+                name, rate(source.risk_at, points), rate(source.risk_at, hits)))
+            print('{} lowest_risk_nearby (1 km): {}'.format(
+                name, rate(source.lowest_risk_nearby, hits[:queries // 10])))
+        print('linear scan risk_at: {}'.format(
+            rate(lambda lat, lng, hour: linear_risk_at(index, lat, lng, hour), (points + hits)[::100])))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--load']:
+        measure_load(*sys.argv[2:])
+    else:
+        main()
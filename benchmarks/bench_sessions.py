@@ -0,0 +1,64 @@
+"""Measures the session stores with 1M users
+
+Reports the Python heap used by the in-memory store (tracemalloc) and
+the file size of the SQLite store, plus get/save rates of both.
+
+Run from the repository root: python benchmarks/bench_sessions.py
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sessions import MemorySessionStore, SQLiteSessionStore  # noqa: E402
+
+USERS = 1000000
+COUNTIES = ['County {}, TX'.format(number) for number in range(250)]
+
+
+def fill(store, users):
+    start = time.perf_counter()
+    for number in range(users):
+        record = store.get(str(1000000000000000 + number))
+        record['dest_type'] = 'Grocery'
+        record['orig_county'] = COUNTIES[number % len(COUNTIES)]
+        record['state'] = 'Texas'
+        record['state_short'] = 'TX'
+        record['safer_county'] = COUNTIES[(number + 1) % len(COUNTIES)]
+        record['subscribe_county'] = record['orig_county']
+        store.save(str(1000000000000000 + number), record)
+    return time.perf_counter() - start
+
+
+def read(store, users):
+    start = time.perf_counter()
+    for number in range(0, users, 7):
+        store.get(str(1000000000000000 + number))['orig_county']
+    return (time.perf_counter() - start) / len(range(0, users, 7))
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+
+    tracemalloc.start()
+    memory = MemorySessionStore(max_entries=users)
+    elapsed = fill(memory, users)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('memory: {} users, {:.0f} MB heap ({:.0f} bytes/user), {:.2f} us/save, {:.2f} us/get'.format(
+        len(memory), current / 1e6, current / users, elapsed / users * 1e6, read(memory, users) * 1e6))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sessions.db')
+        sqlite = SQLiteSessionStore(path)
+        elapsed = fill(sqlite, users)
+        print('sqlite: {} users, {:.0f} MB file ({:.0f} bytes/user), {:.2f} us/save, {:.2f} us/get'.format(
+            len(sqlite), os.path.getsize(path) / 1e6, os.path.getsize(path) / users,
+            elapsed / users * 1e6, read(sqlite, users) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
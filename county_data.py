@@ -0,0 +1,473 @@
+import collections
+import csv
+import fcntl
+import io
+import logging
+import os
+import threading
+
+from metrics import timed
+
+import requests
+
+from snapshot import ChangeDetector, CountySnapshot, SNAPSHOT_PATH, SnapshotBuilder
+
+COUNTY_DATA_URL = os.environ.get(
+    'COUNTY_DATA_URL',
+    'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv')
+# Seconds between two refreshes of the county case data
+COUNTY_DATA_REFRESH = int(os.environ.get('COUNTY_DATA_REFRESH', 3600))
+# Seconds between two checks of the processes not refreshing the data
+# for a snapshot written by the one that does
+SNAPSHOT_POLL = int(os.environ.get('COUNTY_SNAPSHOT_POLL', 60))
+# Bytes before the last known end of file requested again on a refresh,
+# used to detect that the file was rewritten rather than appended to
+OVERLAP_BYTES = 256
+# Seconds to wait for the server to connect or send the next bytes
+COUNTY_DATA_TIMEOUT = 30
+# Bytes of a full download decoded and parsed at a time
+CHUNK_SIZE = 1 << 16
+
+# Suffixes Google Maps appends to county names but the NYT data omits
+COUNTY_SUFFIXES = (' city and borough', ' census area', ' municipality',
+                   ' borough', ' county', ' parish')
+
+STATE_ABBREVIATIONS = {
+    'Alabama': 'AL', 'Alaska': 'AK', 'Arizona': 'AZ', 'Arkansas': 'AR',
+    'California': 'CA', 'Colorado': 'CO', 'Connecticut': 'CT',
+    'Delaware': 'DE', 'District of Columbia': 'DC', 'Florida': 'FL',
+    'Georgia': 'GA', 'Guam': 'GU', 'Hawaii': 'HI', 'Idaho': 'ID',
+    'Illinois': 'IL', 'Indiana': 'IN', 'Iowa': 'IA', 'Kansas': 'KS',
+    'Kentucky': 'KY', 'Louisiana': 'LA', 'Maine': 'ME', 'Maryland': 'MD',
+    'Massachusetts': 'MA', 'Michigan': 'MI', 'Minnesota': 'MN',
+    'Mississippi': 'MS', 'Missouri': 'MO', 'Montana': 'MT',
+    'Nebraska': 'NE', 'Nevada': 'NV', 'New Hampshire': 'NH',
+    'New Jersey': 'NJ', 'New Mexico': 'NM', 'New York': 'NY',
+    'North Carolina': 'NC', 'North Dakota': 'ND',
+    'Northern Mariana Islands': 'MP', 'Ohio': 'OH', 'Oklahoma': 'OK',
+    'Oregon': 'OR', 'Pennsylvania': 'PA', 'Puerto Rico': 'PR',
+    'Rhode Island': 'RI', 'South Carolina': 'SC', 'South Dakota': 'SD',
+    'Tennessee': 'TN', 'Texas': 'TX', 'Utah': 'UT', 'Vermont': 'VT',
+    'Virgin Islands': 'VI', 'Virginia': 'VA', 'Washington': 'WA',
+    'West Virginia': 'WV', 'Wisconsin': 'WI', 'Wyoming': 'WY',
+}
+STATE_NAMES = {short: name for name, short in STATE_ABBREVIATIONS.items()}
+
+CountyRecord = collections.namedtuple(
+    'CountyRecord', ['date', 'county', 'state', 'fips', 'cases', 'deaths'])
+
+logger = logging.getLogger(__name__)
+
+
+def file_version(path):
+    """Identifies a version of a file replaced atomically
+
+    :returns: (inode, modification time in ns) tuple
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def normalize_county_name(name):
+    """Normalizes a county name so Google Maps and NYT names compare equal
+
+    :param name: county name (Ex- Dallas County, St. Louis city)
+    :returns: lower cased name without the county type suffix
+        (Ex- dallas, st louis city)
+    """
+    name = name.lower().replace('.', '').strip()
+    for suffix in COUNTY_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+class CountyCaseStore(object):
+    """Process-wide index of the latest NYT case numbers per county
+
+    The dataset is downloaded once and the most recent row of every
+    county is kept in memory, keyed by (state, county) and by FIPS code,
+    so a lookup is a dict read. A daemon timer refreshes the index every
+    `refresh_interval` seconds.
+
+    The NYT file only grows by rows appended at its end, so a refresh
+    sends a conditional Range request for the bytes after the last one
+    already parsed and indexes only the new rows. A few bytes before
+    that offset are requested again and compared with what was read
+    last time; if they differ, or the file got shorter, the file was
+    rewritten and the whole dataset is reloaded.
+
+    Of the processes sharing the snapshot file, only the one holding the
+    lock of the file refreshes the data. The others map the file again
+    whenever it is replaced and index its latest numbers, and one of them
+    takes over the refreshes if that process exits.
+    """
+
+    def __init__(self, url=COUNTY_DATA_URL, refresh_interval=COUNTY_DATA_REFRESH,
+                 snapshot_path=SNAPSHOT_PATH):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.snapshot_path = snapshot_path
+        self.snapshot = None
+        self._builder = None
+        self._listeners = []
+        self._change_listeners = []
+        self._detector = ChangeDetector()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._by_name = {}
+        self._by_fips = {}
+        self._loaded = False
+        self._timer = None
+        # Open lock file of the snapshot while this process refreshes it
+        self._refresh_lock = None
+        self._refreshing = False
+        # Version of the snapshot file mapped, see file_version()
+        self._snapshot_version = None
+        # Position after the last complete line parsed, the bytes just
+        # before it and the validators of the response it came from
+        self._offset = 0
+        self._tail = b''
+        self._etag = None
+        self._last_modified = None
+
+    def _apply_rows(self, rows, by_name, by_fips, builder):
+        """Indexes CSV rows, later rows replacing earlier ones"""
+        for row in rows:
+            builder.add_row(row)
+            if len(row) < 6 or row[0] == 'date':
+                continue
+            try:
+                record = CountyRecord(row[0], row[1], row[2], row[3],
+                                      int(row[4]), int(row[5] or 0))
+            except ValueError:
+                continue
+            by_name[(record.state.lower(), normalize_county_name(record.county))] = record
+            if record.fips:
+                by_fips[record.fips] = record
+
+    def _parse(self, chunks, by_name, by_fips, builder):
+        """Indexes the complete lines of a body read in chunks
+
+        Lines are decoded and parsed as the chunks arrive, so the body
+        is never held in memory as a whole.
+
+        :param chunks: iterable of bytes
+        :returns: (number of bytes consumed, up to the last newline,
+            the last OVERLAP_BYTES of them)
+        """
+        end = 0
+        tail = b''
+
+        def lines():
+            nonlocal end, tail
+            pending = b''
+            for chunk in chunks:
+                data = pending + chunk
+                complete = data.rfind(b'\n') + 1
+                if complete:
+                    end += complete
+                    tail = (tail + data[max(0, complete - OVERLAP_BYTES):complete])[-OVERLAP_BYTES:]
+                    yield from io.StringIO(data[:complete].decode('utf-8'))
+                pending = data[complete:]
+
+        self._apply_rows(csv.reader(lines()), by_name, by_fips, builder)
+        return end, tail
+
+    def _remember(self, response, tail, offset):
+        """Stores the validators and tail of the data parsed so far"""
+        self._offset = offset
+        self._tail = tail
+        self._etag = response.headers.get('ETag')
+        self._last_modified = response.headers.get('Last-Modified')
+
+    def load(self):
+        """Downloads the whole dataset and rebuilds the index"""
+        with timed('county_data_download'):
+            with requests.get(self.url, headers={'Accept-Encoding': 'identity'},
+                              stream=True, timeout=COUNTY_DATA_TIMEOUT) as response:
+                response.raise_for_status()
+                self._replace(response)
+
+    def _replace(self, response):
+        by_name = {}
+        by_fips = {}
+        builder = SnapshotBuilder()
+        end, tail = self._parse(response.iter_content(CHUNK_SIZE), by_name, by_fips, builder)
+        with self._lock:
+            self._by_name = by_name
+            self._by_fips = by_fips
+            self._builder = builder
+            self._loaded = True
+            self._remember(response, tail, end)
+        self._write_snapshot()
+
+    def update(self):
+        """Fetches and indexes only the rows appended since the last fetch
+
+        :returns: True if the index changed, False if the file didn't
+        """
+        if self._builder is None:
+            self.load()
+            return True
+        start = self._offset - len(self._tail)
+        headers = {'Accept-Encoding': 'identity',
+                   'Range': 'bytes={}-'.format(start)}
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        elif self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified
+        with timed('county_data_update'):
+            with requests.get(self.url, headers=headers, stream=True,
+                              timeout=COUNTY_DATA_TIMEOUT) as response:
+                return self._apply_update(response, start)
+
+    def _apply_update(self, response, start):
+        """Indexes the answer to a Range request starting at `start`"""
+        if response.status_code == 304:
+            return False
+        if response.status_code == 416:
+            # The file is now shorter than what was already parsed
+            self.load()
+            return True
+        response.raise_for_status()
+        if response.status_code != 206:
+            # The server ignored the Range header and sent the whole file
+            self._replace(response)
+            return True
+        data = response.content
+        content_range = response.headers.get('Content-Range', '')
+        if (not content_range.startswith('bytes {}-'.format(start)) or
+                not data.startswith(self._tail)):
+            logger.info('County data at %s was rewritten, reloading', self.url)
+            self.load()
+            return True
+        appended = data[len(self._tail):]
+        with self._lock:
+            end, tail = self._parse([appended], self._by_name, self._by_fips, self._builder)
+            self._remember(response, (self._tail + tail)[-OVERLAP_BYTES:],
+                           self._offset + end)
+        if end:
+            self._write_snapshot()
+        return end > 0
+
+    def _write_snapshot(self):
+        """Writes the time series snapshot and maps the new file"""
+        if not self.snapshot_path:
+            return
+        self._builder.write(self.snapshot_path)
+        self.snapshot = CountySnapshot(self.snapshot_path)
+        self._snapshot_version = file_version(self.snapshot_path)
+        self._notify(built=True)
+
+    def add_listener(self, callback):
+        """Registers a callback run with the new snapshot after each refresh
+
+        :param callback: function taking a CountySnapshot; it is also
+            called right away if a snapshot is already mapped
+        """
+        self._listeners.append(callback)
+        if self.snapshot is not None:
+            callback(self.snapshot)
+
+    def add_change_listener(self, callback):
+        """Registers a callback run after each refresh of this process with
+        the counties whose numbers changed
+
+        The numbers are compared with the previous snapshot this process
+        mapped, whichever process wrote it: the first refresh after a
+        restart is compared with the snapshot left on disk.
+
+        :param callback: function taking the int32 array of the FIPS
+            codes of the changed counties
+        """
+        self._change_listeners.append(callback)
+
+    def _notify(self, built=False):
+        changed = self._detector.update(self.snapshot)
+        for callback in self._listeners:
+            try:
+                callback(self.snapshot)
+            except Exception:
+                logger.exception('County data listener %r failed', callback)
+        if not built or changed is None or not len(changed):
+            return
+        for callback in self._change_listeners:
+            try:
+                callback(changed)
+            except Exception:
+                logger.exception('County change listener %r failed', callback)
+
+    def open_snapshot(self):
+        """Maps the snapshot file left by a previous refresh, if any
+
+        :returns: True if a snapshot was opened
+        """
+        if self.snapshot is None and self.snapshot_path and os.path.exists(self.snapshot_path):
+            self._snapshot_version = file_version(self.snapshot_path)
+            self.snapshot = CountySnapshot(self.snapshot_path)
+            self._notify()
+        return self.snapshot is not None
+
+    def follow(self):
+        """Maps the snapshot file again if another process replaced it
+
+        The latest numbers of every county are taken from the new
+        snapshot, dated by its last day. Counties keep the names of the
+        last download of this process, and rows without a FIPS code
+        (Ex- New York City) keep their numbers.
+
+        :returns: True if a new snapshot was mapped
+        """
+        if not self.snapshot_path:
+            return False
+        try:
+            version = file_version(self.snapshot_path)
+        except OSError:
+            return False
+        if version == self._snapshot_version:
+            return False
+        snapshot = CountySnapshot(self.snapshot_path)
+        by_name = dict(self._by_name)
+        by_fips = {}
+        if len(snapshot.dates):
+            date = snapshot.last_date
+            for fips, cases, deaths in zip(snapshot.fips.tolist(), snapshot.cases[-1].tolist(),
+                                           snapshot.deaths[-1].tolist()):
+                fips = '{:05d}'.format(fips)
+                previous = self._by_fips.get(fips)
+                if previous:
+                    record = previous._replace(date=date, cases=cases, deaths=deaths)
+                    by_name[(record.state.lower(), normalize_county_name(record.county))] = record
+                else:
+                    record = CountyRecord(date, '', '', fips, cases, deaths)
+                by_fips[fips] = record
+        with self._lock:
+            self._by_name = by_name
+            self._by_fips = by_fips
+            self._loaded = self._loaded or bool(by_fips)
+            self.snapshot = snapshot
+            self._snapshot_version = version
+        self._notify()
+        return True
+
+    def trend(self, fips, days=7):
+        """New cases and growth rate of a county over the last `days` days
+
+        :param fips: 5 digit county FIPS code (Ex- 48113)
+        :returns: (new_cases, growth_rate) tuple, growth_rate being None
+            when it can't be computed, or None if there is no history
+        """
+        snapshot = self.snapshot
+        if snapshot is None or not fips:
+            return None
+        new_cases = snapshot.new_cases(fips, days)
+        if new_cases is None:
+            return None
+        return new_cases, snapshot.growth_rate(fips, days)
+
+    def refresh(self):
+        """Updates the index, keeping the old one if the download fails"""
+        try:
+            self.update()
+        except Exception:
+            logger.exception('Failed to refresh county data from %s', self.url)
+
+    def start(self):
+        """Loads the index if needed and schedules periodic refreshes
+
+        If another process refreshes the shared snapshot, its snapshots
+        are followed instead until that process exits.
+        """
+        with self._start_lock:
+            if not self._take_refreshes():
+                self.follow()
+            elif not self._loaded:
+                self.refresh()
+            if self.refresh_interval and not self._timer:
+                self._schedule()
+
+    def _take_refreshes(self):
+        """Tells whether this process refreshes the data, taking the lock
+        of the snapshot file if no other process holds it
+        """
+        if self._refreshing:
+            return True
+        if self.snapshot_path:
+            # The lock belongs to the open file, which forked children
+            # share: it is never taken before a fork (gunicorn master)
+            try:
+                directory = os.path.dirname(self.snapshot_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                lock = open(self.snapshot_path + '.lock', 'a')
+            except OSError:
+                logger.exception('Failed to open the lock of %s, refreshing in this process', self.snapshot_path)
+            else:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock.close()
+                    return False
+                self._refresh_lock = lock
+        self._refreshing = True
+        return True
+
+    def _schedule(self):
+        interval = self.refresh_interval if self._refreshing else min(self.refresh_interval, SNAPSHOT_POLL)
+        self._timer = threading.Timer(interval, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        if self._take_refreshes():
+            self.refresh()
+        else:
+            try:
+                self.follow()
+            except Exception:
+                logger.exception('Failed to map the county snapshot %s', self.snapshot_path)
+        self._schedule()
+
+    def stop(self):
+        """Cancels the periodic refresh and lets another process take over"""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._refresh_lock:
+            self._refresh_lock.close()
+            self._refresh_lock = None
+        self._refreshing = False
+
+    @property
+    def loaded(self):
+        """Tells whether the case index holds data"""
+        return self._loaded
+
+    def _ensure_loaded(self):
+        # Lookups never download: until warm_up() or the refresh timer
+        # loaded the index, they find nothing
+        if not self._loaded:
+            self.open_snapshot()
+
+    def lookup(self, state, county):
+        """Finds the latest numbers of a county
+
+        :param state: state name in long format (Ex- Texas)
+        :param county: county name (Ex- Dallas County)
+        :returns: CountyRecord or None if the county is unknown
+        """
+        self._ensure_loaded()
+        return self._by_name.get((state.lower(), normalize_county_name(county)))
+
+    def lookup_fips(self, fips):
+        """Finds the latest numbers of a county by its FIPS code
+
+        :param fips: 5 digit county FIPS code (Ex- 48113)
+        :returns: CountyRecord or None if the county is unknown
+        """
+        self._ensure_loaded()
+        return self._by_fips.get(fips)
+
+
+county_store = CountyCaseStore()
@@ -0,0 +1,85 @@
+"""Idempotency of webhook events redelivered by Messenger
+
+Messenger delivers a batch again when the webhook answers late or with
+an error. Each event is identified by its message id or, for postbacks
+and optins, by its sender, kind and timestamp, and ids seen within a
+time window are kept in a bounded set so a redelivered event is dropped
+before any work is done.
+"""
+import collections
+import os
+import threading
+import time
+
+# Seconds an event id is remembered, longer than Messenger retries
+DEDUP_WINDOW = int(os.environ.get('DEDUP_WINDOW', 3600))
+DEDUP_SIZE = int(os.environ.get('DEDUP_SIZE', 100000))
+
+
+def event_key(message):
+    """Identifies a messaging event of the webhook payload
+
+    :param message: an entry.messaging item of the webhook payload
+    :returns: key string or None if the event carries no identity
+    """
+    for kind in ('message', 'postback', 'optin'):
+        event = message.get(kind)
+        if not event:
+            continue
+        if event.get('mid'):
+            return 'mid:' + event['mid']
+        if message.get('timestamp'):
+            return '{}:{}:{}'.format(kind, message.get('sender', {}).get('id'), message['timestamp'])
+    return None
+
+
+class EventDeduplicator(object):
+    """Bounded, time-windowed set of seen event keys
+
+    :param window: seconds a key is remembered
+    :param max_entries: keys kept before forgetting the oldest one
+    """
+
+    def __init__(self, window=DEDUP_WINDOW, max_entries=DEDUP_SIZE):
+        self.window = window
+        self.max_entries = max_entries
+        self.counters = collections.Counter()
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """Records a key unless it was seen within the window
+
+        :returns: True for a new event, False for a duplicate
+        """
+        now = time.time()
+        with self._lock:
+            while self._seen:
+                oldest, seen_at = next(iter(self._seen.items()))
+                if now - seen_at < self.window and len(self._seen) < self.max_entries:
+                    break
+                del self._seen[oldest]
+            if key in self._seen:
+                self.counters['dropped'] += 1
+                return False
+            self._seen[key] = now
+            self.counters['accepted'] += 1
+            return True
+
+    def release(self, keys):
+        """Forgets claimed keys whose events were not accepted after all,
+        so their redelivery is handled
+        """
+        with self._lock:
+            for key in keys:
+                if self._seen.pop(key, None) is not None:
+                    self.counters['accepted'] -= 1
+
+    def stats(self):
+        """Returns the accepted and dropped counters and the set size"""
+        with self._lock:
+            return {'accepted': self.counters['accepted'], 'dropped': self.counters['dropped'],
+                    'entries': len(self._seen)}
+
+
+event_dedup = EventDeduplicator()
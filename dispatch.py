@@ -0,0 +1,194 @@
+"""Webhook event dispatch on a bounded worker pool
+
+Events are queued per recipient and run in arrival order for a given
+recipient, while different recipients are served in parallel by a fixed
+set of worker threads. A handler written as a generator can `yield` a
+number of seconds to pause (Ex- a typing delay between two sends): the
+worker is freed while the recipient's queue stays on hold until the
+delay is over, so later events of that recipient still run after it.
+
+Calls can be tagged (kind, value) to coalesce a burst of one recipient:
+a new call replaces the queued calls of the same kind, and is dropped
+when the call running for the recipient has the very same tag.
+"""
+import collections
+import heapq
+import inspect
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', 4))
+# Events accepted but not started yet before the webhook pushes back
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 1000))
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when accepting events would exceed the queue size"""
+
+
+class EventDispatcher(object):
+    """Per-recipient FIFO dispatcher running handlers on worker threads
+
+    :param workers: number of worker threads
+    :param max_pending: maximum number of queued events not yet started
+    """
+
+    def __init__(self, workers=EVENT_WORKERS, max_pending=EVENT_QUEUE_SIZE):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # Recipient id -> deque of queued handlers and paused generators,
+        # present while the recipient has work running, paused or queued
+        self._lanes = {}
+        self._ready = queue.Queue()
+        self._paused = []
+        self._sequence = itertools.count()
+        # Recipient id -> tag of its running or paused call, None if
+        # untagged
+        self._active = {}
+        self._pending = 0
+        self._coalesced = 0
+        self._threads = []
+
+    def start(self):
+        """Starts the worker and timer threads if not already running"""
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name='event-worker-{}'.format(number))
+                thread.daemon = True
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._resume_paused, name='event-timer')
+            thread.daemon = True
+            self._threads.append(thread)
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, handler, *args):
+        """Queues one handler call for a recipient
+
+        :param key: recipient id, calls with the same key run in order
+        :param handler: function, possibly a generator function
+        :raises QueueFull: if max_pending events are already queued
+        """
+        self.submit_many([(key, handler) + args])
+
+    def submit_many(self, calls, tags=None):
+        """Queues several handler calls, either all of them or none
+
+        :param calls: list of (key, handler, *args) tuples
+        :param tags: list of (kind, value) tags or None aligned with
+            calls, None to never coalesce
+        :raises QueueFull: if the calls don't fit in the queue
+        """
+        self.start()
+        with self._lock:
+            if self._pending + len(calls) > self.max_pending:
+                raise QueueFull('{} events already queued'.format(self._pending))
+            for call, tag in zip(calls, tags or [None] * len(calls)):
+                key, handler, args = call[0], call[1], call[2:]
+                if tag is not None and not self._coalesce(key, tag):
+                    continue
+                self._pending += 1
+                self._enqueue(key, (handler, args, tag))
+
+    def _coalesce(self, key, tag):
+        """Drops the queued calls a new tagged call supersedes
+
+        :returns: False if the new call itself is dropped
+        """
+        if key in self._active and self._active[key] == tag:
+            self._coalesced += 1
+            return False
+        lane = self._lanes.get(key)
+        if lane:
+            kept = [item for item in lane if inspect.isgenerator(item) or item[2] is None or item[2][0] != tag[0]]
+            dropped = len(lane) - len(kept)
+            if dropped:
+                lane.clear()
+                lane.extend(kept)
+                self._pending -= dropped
+                self._coalesced += dropped
+        return True
+
+    def _enqueue(self, key, item, first=False):
+        """Adds work to a recipient lane, marking it ready if it was idle"""
+        lane = self._lanes.get(key)
+        if lane is None:
+            self._lanes[key] = collections.deque([item])
+            self._ready.put(key)
+        elif first:
+            # Only paused generators go first, their lane is on hold
+            lane.appendleft(item)
+            self._ready.put(key)
+        else:
+            # Also when coalescing just emptied the lane: its key is
+            # still in the ready queue or its call is running
+            lane.append(item)
+
+    def stats(self):
+        """Returns queue depth counters
+
+        :returns: dict with pending (queued, not started), paused
+            (waiting for a delay), recipients (with work), coalesced
+            (calls dropped for a newer one) and max_pending
+        """
+        with self._lock:
+            return {'pending': self._pending, 'paused': len(self._paused),
+                    'recipients': len(self._lanes), 'coalesced': self._coalesced,
+                    'max_pending': self.max_pending}
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                item = self._lanes[key].popleft()
+                if not inspect.isgenerator(item):
+                    self._pending -= 1
+                    self._active[key] = item[2]
+            try:
+                if inspect.isgenerator(item):
+                    generator = item
+                else:
+                    handler, args, _ = item
+                    generator = handler(*args)
+                delay = next(generator) if inspect.isgenerator(generator) else None
+            except StopIteration:
+                delay = None
+            except Exception:
+                logger.exception('Event handler failed for recipient %s', key)
+                delay = None
+            with self._lock:
+                if delay is not None:
+                    heapq.heappush(self._paused, (time.time() + delay, next(self._sequence), key, generator))
+                    self._wakeup.notify()
+                    continue
+                del self._active[key]
+                if self._lanes[key]:
+                    self._ready.put(key)
+                else:
+                    del self._lanes[key]
+
+    def _resume_paused(self):
+        with self._lock:
+            while True:
+                if not self._paused:
+                    self._wakeup.wait()
+                    continue
+                due = self._paused[0][0] - time.time()
+                if due > 0:
+                    self._wakeup.wait(due)
+                    continue
+                _, _, key, generator = heapq.heappop(self._paused)
+                self._enqueue(key, generator, first=True)
+
+
+dispatcher = EventDispatcher()
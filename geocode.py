@@ -0,0 +1,151 @@
+"""Cache of address to county lookups in front of the Maps geocoder
+
+Addresses are normalized before lookup (case, whitespace, punctuation,
+ZIP+4 reduced to the ZIP code) so the many spellings of the same city or
+ZIP code share an entry. Only the (county, state, state_short) tuple is
+kept, in an in-memory LRU backed by a SQLite file so a warm cache
+survives deploys.
+"""
+import collections
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from metrics import timed
+
+GEOCODE_DB = os.environ.get('GEOCODE_DB', 'geocode.db')
+# Seconds a geocoded county is reused before asking the Maps API again
+GEOCODE_TTL = int(os.environ.get('GEOCODE_TTL', 30 * 86400))
+GEOCODE_CACHE_SIZE = int(os.environ.get('GEOCODE_CACHE_SIZE', 50000))
+
+ZIP_CODE = re.compile(r'^(\d{5})(?:-?\d{4})?$')
+PUNCTUATION = re.compile(r'[^\w\s#-]')
+
+Location = collections.namedtuple('Location', ['county', 'state', 'state_short'])
+
+
+def normalize_address(address):
+    """Reduces an address to the key it is cached under
+
+    :param address: free text address (Ex- ' Dallas,  TX ', '75201-1234')
+    :returns: normalized key (Ex- 'dallas tx', 'zip:75201')
+    """
+    address = ' '.join(PUNCTUATION.sub(' ', address.lower()).split())
+    match = ZIP_CODE.match(address.replace(' ', ''))
+    if match:
+        return 'zip:' + match.group(1)
+    return address
+
+
+def extract_location(result):
+    """Extracts the county and state from a geocode result
+
+    :param result: one result of googlemaps.Client.geocode
+    :returns: Location, with empty strings for missing parts
+    """
+    state = state_short = county = ""
+    for element in result['address_components']:
+        if 'administrative_area_level_1' in element['types']:
+            state_short = element['short_name']
+            state = element['long_name']
+        if 'administrative_area_level_2' in element['types']:
+            county = element['short_name']
+    return Location(county, state, state_short)
+
+
+class GeocodeCache(object):
+    """LRU and SQLite cache of geocoded counties
+
+    :param path: SQLite database file, None to keep the cache in memory
+    :param ttl: seconds an entry stays valid
+    :param max_entries: entries kept in memory
+    """
+
+    def __init__(self, path=GEOCODE_DB, ttl=GEOCODE_TTL, max_entries=GEOCODE_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        # One connection per thread and process, never shared after a fork
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, county TEXT, '
+                       'state TEXT, state_short TEXT, stored_at REAL NOT NULL) WITHOUT ROWID')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _remember(self, key, location, stored_at):
+        with self._lock:
+            self._entries[key] = (location, stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Returns the cached Location of a normalized address or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                return entry[0]
+        if not self.path:
+            return None
+        row = self._connect().execute(
+            'SELECT county, state, state_short, stored_at FROM geocode WHERE key = ? AND stored_at >= ?',
+            (key, now - self.ttl)).fetchone()
+        if row is None:
+            return None
+        location = Location(*row[:3])
+        self._remember(key, location, row[3])
+        return location
+
+    def put(self, key, location):
+        """Caches the Location of a normalized address"""
+        now = time.time()
+        self._remember(key, location, now)
+        if self.path:
+            self._connect().execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)',
+                                    (key,) + tuple(location) + (now,))
+
+    def resolve(self, address, client):
+        """Finds the county of an address, geocoding it on a cache miss
+
+        :param address: free text address
+        :param client: googlemaps.Client used on a miss
+        :returns: Location or None if the address can't be geocoded
+        """
+        key = normalize_address(address)
+        location = self.get(key)
+        with self._lock:
+            if location is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if location is not None:
+            return location
+        with timed('geocode'):
+            results = client.geocode(address)
+        if not results:
+            return None
+        location = extract_location(results[0])
+        self.put(key, location)
+        return location
+
+    def stats(self):
+        """Returns the hit and miss counters and the in-memory size"""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+geocode_cache = GeocodeCache()
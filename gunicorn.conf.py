@@ -0,0 +1,48 @@
+"""Gunicorn settings of the production server (see Procfile)
+
+The app is preloaded in the master, which loads the shared data once
+(wsgi.py), sets up the Messenger page and freezes the loaded objects out
+of the garbage collector so the workers keep sharing their pages. Each
+worker then starts its own background threads. One worker refreshes the
+county data (it holds the lock of the snapshot file), the others map
+each snapshot it writes. Workers serve requests on several threads; the
+webhook only queues events, the sends run on the dispatcher threads of
+the worker.
+
+Conversation state must be visible to every worker, since the steps of
+one conversation may land on different workers, so the SQLite session
+store is the default here. The webhook event deduplicator and the
+/metrics counters stay per worker.
+"""
+import gc
+import os
+
+# Read by sessions.py when the preloaded app is imported
+os.environ.setdefault('SESSION_STORE', 'sqlite')
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 5000))
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+preload_app = True
+timeout = 30
+accesslog = '-'
+
+
+def when_ready(server):
+    from app import setup_page
+    from messenger import send_client
+    try:
+        setup_page()
+    except Exception:
+        server.log.exception('Failed to set up the Messenger page')
+    # Workers open their own connections, not the master's pooled ones
+    send_client.session.close()
+    # Objects loaded so far are never collected, so the collector doesn't
+    # write to (and copy) their pages in the workers
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import start_background
+    start_background()
@@ -1,41 +1,30 @@
-import json
-import os
-
-from pymessenger2.bot import Bot
-
-import requests
-
-ACCESS_TOKEN = os.environ.get('ACCESS_TOKEN')
-COUNTY_ADJACENCY = 'https://www2.census.gov/geo/docs/reference/county_adjacency.txt'
-bot = Bot(ACCESS_TOKEN)
+from messenger import send_client
 
 
 def set_get_started_button_payload():
-    """Sets the 'Get Started' payload
+    """Sets the 'Get Started' payload, once per process
 
-    :returns: requests.Response object created from a
-        POST request to the messenger
+    :returns: decoded Graph API response, None if already set
     """
     data = {"setting_type": "call_to_actions",
             "thread_state": "new_thread",
             "call_to_actions": [{"payload": 'GET_STARTED'}]}
-    url = bot.graph_url + "/me/thread_settings?access_token={token}"
-    return requests.post(url.format(token=bot.access_token),
-                         headers={"Content-Type": "application/json"},
-                         data=json.dumps(data))
+    return send_client.apply_setting(data)
 
 
 def set_greeting_text(text):
-    """Sets the greeting text for the bot
+    """Sets the greeting text for the bot, once per process
 
-    :returns: requests.Response object created from a
-        POST request to the messenger
+    :returns: decoded Graph API response, None if already set
     """
     data = {"setting_type": "greeting", "greeting": {"text": text}}
-    url = bot.graph_url + "/me/thread_settings?access_token={token}"
-    return requests.post(url.format(token=bot.access_token),
-                         headers={"Content-Type": "application/json"},
-                         data=json.dumps(data))
+    return send_client.apply_setting(data)
+
+
+def setup_page():
+    """Applies the page thread settings, meant to run at startup"""
+    set_greeting_text('Hi {{user_first_name}}!')
+    set_get_started_button_payload()
 
 
 def send_message(recipient_id, response):
@@ -44,7 +33,7 @@ def send_message(recipient_id, response):
     :param recipient_id: user id to send the message to
     :param response: text to send
     """
-    bot.send_text_message(recipient_id, response)
+    send_client.send_text_message(recipient_id, response)
 
 
 def send_start_options(recipient_id):
@@ -62,8 +51,8 @@ def send_start_options(recipient_id):
     buttons.append(button)
     button = create_quick_reply_button('text', 'Other', 'OTHER')
     buttons.append(button)
-    bot.send_quick_reply(recipient_id,
-                         "Where do you plan to travel today?", buttons)
+    send_client.send_quick_reply(recipient_id,
+                                 "Where do you plan to travel today?", buttons)
 
 
 def create_quick_reply_button(type, title, payload, image_url=None):
@@ -80,12 +69,20 @@ def create_quick_reply_button(type, title, payload, image_url=None):
     return button
 
 
-def send_notification_request(recipient_id, title, payload):
-    """Sends the one time notification request
+def create_url_button(title, url):
+    """Creates a URL button
+
+    Refer https://developers.facebook.com/docs/messenger-platform/reference/buttons/url
+    """
+    return {'type': 'web_url', 'title': title, 'url': url}
+
+
+def create_notification_request(title, payload):
+    """Creates a one time notification request message
 
     Refer https://developers.facebook.com/docs/messenger-platform/send-messages/one-time-notification
     """
-    message = {
+    return {
         'attachment': {
             'type': 'template',
             'payload': {
@@ -95,15 +92,22 @@ def send_notification_request(recipient_id, title, payload):
             }
         }
     }
-    bot.send_message(recipient_id, message)
 
 
-def send_follow_up_message(token, content):
-    """Sends the follow up message to the subscribed users
+def send_notification_request(recipient_id, title, payload):
+    """Sends the one time notification request
 
     Refer https://developers.facebook.com/docs/messenger-platform/send-messages/one-time-notification
     """
-    body = {
+    send_client.send_message(recipient_id, create_notification_request(title, payload))
+
+
+def create_follow_up_message(token, content):
+    """Creates the Send API body of a follow up message to a subscribed user
+
+    Refer https://developers.facebook.com/docs/messenger-platform/send-messages/one-time-notification
+    """
+    return {
         'recipient': {
             'one_time_notif_token': token
         },
@@ -111,32 +115,3 @@ def send_follow_up_message(token, content):
             'text': content
         }
     }
-    bot.send_raw(body)
-
-
-def create_county_adjacency_dict():
-    """Creates a county adjacency dict of all adjacent US counties
-
-    :returns: dict having keys as county name and values as list of
-        all its adjacent counties
-    """
-    county_file = requests.get(COUNTY_ADJACENCY)
-    data = county_file.text.translate(str.maketrans('', '', '1234567890'))
-    with open('sample.txt', 'w') as f:
-        f.write(data)
-
-    county_dict = {}
-    prev = ""
-    with open('sample.txt') as f:
-        for line in f:
-            data_list = line.strip().split('\t\t')
-
-            while("" in data_list):
-                data_list.remove("")
-
-            if len(data_list) == 2:
-                county_dict[data_list[0][1:-1]] = [data_list[1][1:-1]]
-                prev = data_list[0][1:-1]
-            elif len(data_list) == 1:
-                county_dict[prev].append(data_list[0][1:-1])
-    return county_dict
@@ -0,0 +1,252 @@
+"""Messenger Send API client
+
+All calls share one pooled HTTP session, so the sends of a conversation
+turn reuse the same keep-alive connection to the Graph API. Rate limited
+calls (HTTP 429, Graph error codes 4, 17, 32 and 613) and server errors
+are retried with jittered exponential backoff, honouring Retry-After and
+slowing down when the usage headers report the app close to its limits.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from metrics import registry, timed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ACCESS_TOKEN = os.environ.get('ACCESS_TOKEN')
+GRAPH_API_URL = os.environ.get('GRAPH_API_URL', 'https://graph.facebook.com/v2.6')
+# Maximum number of requests in one Graph batch call
+BATCH_SIZE = 50
+RATE_LIMIT_CODES = (4, 17, 32, 613)
+USAGE_HEADERS = ('X-App-Usage', 'X-Page-Usage', 'X-Business-Use-Case-Usage')
+# Usage percentage from which calls are spaced out
+USAGE_THRESHOLD = 90
+# Seconds during which a sender action is still shown to the user
+ACTION_TTL = 20
+
+logger = logging.getLogger(__name__)
+
+
+class SendError(Exception):
+    """Raised when the Graph API rejects a call for good"""
+
+
+def _usage_percent(value):
+    """Returns the highest percentage found in a Graph usage header
+
+    X-App-Usage and X-Page-Usage hold one object of percentages,
+    X-Business-Use-Case-Usage a list of such objects per business id.
+    """
+    try:
+        usage = json.loads(value)
+    except ValueError:
+        return 0
+    if not isinstance(usage, dict):
+        return 0
+    entries = [usage]
+    if usage and all(isinstance(entry, list) for entry in usage.values()):
+        entries = [entry for business in usage.values() for entry in business]
+    return max([entry.get(key) or 0 for entry in entries if isinstance(entry, dict)
+                for key in ('call_count', 'total_cputime', 'total_time')], default=0)
+
+
+def _is_rate_limited(status_code, body):
+    if status_code == 429:
+        return True
+    try:
+        code = json.loads(body)['error']['code']
+    except (ValueError, KeyError, TypeError):
+        return False
+    return code in RATE_LIMIT_CODES
+
+
+def button_template(text, buttons):
+    """Creates a button template message"""
+    return {
+        'attachment': {
+            'type': 'template',
+            'payload': {'template_type': 'button', 'text': text, 'buttons': buttons}
+        }
+    }
+
+
+class SendClient(object):
+    """Pooled Send API client with rate limit aware retries
+
+    :param access_token: page access token
+    :param graph_url: Graph API base url including the version
+    :param pool_size: number of kept-alive connections
+    :param max_retries: attempts after the first one for a failing call
+    """
+
+    def __init__(self, access_token=ACCESS_TOKEN, graph_url=GRAPH_API_URL,
+                 pool_size=10, max_retries=5, backoff=0.5, max_backoff=30):
+        self.access_token = access_token
+        self.graph_url = graph_url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._pause_until = 0
+        self._actions = {}
+        self._settings = set()
+
+    def _delay(self, attempt, retry_after=None):
+        """Returns the seconds to wait before a retry, with full jitter"""
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _note_usage(self, response):
+        """Spaces out the next calls when usage headers are close to 100%"""
+        usage = max([_usage_percent(response.headers[header])
+                     for header in USAGE_HEADERS if header in response.headers], default=0)
+        if usage >= USAGE_THRESHOLD:
+            with self._lock:
+                self._pause_until = max(self._pause_until,
+                                        time.time() + self._delay(usage - USAGE_THRESHOLD))
+
+    def post(self, path, payload=None, data=None):
+        """Posts to the Graph API, retrying rate limited calls
+
+        :param path: path after the versioned graph url (Ex- /me/messages)
+        :param payload: JSON body
+        :param data: form encoded body, used instead of payload
+        :returns: decoded JSON response
+        :raises SendError: if the call still fails after the retries
+        """
+        url = self.graph_url + path
+        for attempt in range(self.max_retries + 1):
+            pause = self._pause_until - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            try:
+                with timed('graph_api'):
+                    response = self.session.post(url, params={'access_token': self.access_token},
+                                                 json=payload, data=data, timeout=10)
+            except requests.ConnectionError:
+                registry.inc('covideye_graph_api_retries_total', help='Graph API calls retried')
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._delay(attempt))
+                continue
+            if response.status_code < 400:
+                self._note_usage(response)
+                return response.json()
+            retry = response.status_code >= 500 or _is_rate_limited(response.status_code, response.text)
+            if not retry or attempt == self.max_retries:
+                raise SendError('{} {}: {}'.format(response.status_code, path, response.text))
+            delay = self._delay(attempt, response.headers.get('Retry-After'))
+            logger.info('Graph API call to %s throttled, retrying in %.1fs', path, delay)
+            registry.inc('covideye_graph_api_retries_total', help='Graph API calls retried')
+            time.sleep(delay)
+
+    def send_raw(self, payload):
+        """Sends a complete Send API body (recipient, message, ...)"""
+        recipient_id = payload.get('recipient', {}).get('id')
+        if recipient_id and 'message' in payload:
+            # A message hides the typing indicator
+            with self._lock:
+                self._actions.pop(recipient_id, None)
+        return self.post('/me/messages', payload)
+
+    def send_message(self, recipient_id, message):
+        """Sends a message dict to a user"""
+        return self.send_raw({'recipient': {'id': recipient_id}, 'message': message})
+
+    def send_text_message(self, recipient_id, text):
+        return self.send_message(recipient_id, {'text': text})
+
+    def send_quick_reply(self, recipient_id, text, quick_replies):
+        return self.send_message(recipient_id, {'text': text, 'quick_replies': quick_replies})
+
+    def send_button_message(self, recipient_id, text, buttons):
+        return self.send_message(recipient_id, button_template(text, buttons))
+
+    def send_action(self, recipient_id, action):
+        """Sends a sender action, skipping it if it is already showing
+
+        Repeating typing_on or mark_seen while the previous one is still
+        in effect changes nothing for the user, so it isn't sent again.
+        """
+        now = time.time()
+        with self._lock:
+            if len(self._actions) > 10000:
+                self._actions = {key: value for key, value in self._actions.items()
+                                 if now - value[1] < ACTION_TTL}
+            last = self._actions.get(recipient_id)
+            if last and last[0] == action and now - last[1] < ACTION_TTL:
+                return None
+            self._actions[recipient_id] = (action, now)
+        return self.post('/me/messages', {'recipient': {'id': recipient_id}, 'sender_action': action})
+
+    def send_batch(self, payloads):
+        """Sends many Send API bodies through Graph batch requests
+
+        Used for fan-out to many users: every batch call carries up to
+        BATCH_SIZE sends over one request. Rate limited sends of a batch
+        are retried in the next round.
+
+        :param payloads: list of Send API bodies
+        :returns: list of (payload, result) pairs, result being the
+            decoded response body or a SendError
+        """
+        results = {}
+        remaining = list(enumerate(payloads))
+        for attempt in range(self.max_retries + 1):
+            retry = []
+            for start in range(0, len(remaining), BATCH_SIZE):
+                chunk = remaining[start:start + BATCH_SIZE]
+                batch = [{'method': 'POST', 'relative_url': 'me/messages',
+                          'body': '&'.join('{}={}'.format(key, requests.utils.quote(json.dumps(value)))
+                                           for key, value in payload.items())}
+                         for _, payload in chunk]
+                responses = self.post('', data={'batch': json.dumps(batch), 'include_headers': 'false'})
+                for (position, payload), response in zip(chunk, responses):
+                    # A null response means the send timed out
+                    code = response.get('code', 500) if response else 500
+                    body = response.get('body', '') if response else ''
+                    if code < 400:
+                        results[position] = json.loads(body) if body else {}
+                    elif attempt < self.max_retries and (code >= 500 or _is_rate_limited(code, body)):
+                        retry.append((position, payload))
+                    else:
+                        results[position] = SendError('{}: {}'.format(code, body))
+            if not retry:
+                break
+            remaining = retry
+            time.sleep(self._delay(attempt))
+        return [(payload, results[position]) for position, payload in enumerate(payloads)]
+
+    def apply_setting(self, setting):
+        """Posts a page thread setting once per process
+
+        Settings are page-wide, so posting the same one again is skipped.
+        """
+        key = hashlib.sha1(json.dumps(setting, sort_keys=True).encode('utf-8')).hexdigest()
+        with self._lock:
+            if key in self._settings:
+                return None
+            self._settings.add(key)
+        try:
+            return self.post('/me/thread_settings', setting)
+        except Exception:
+            with self._lock:
+                self._settings.discard(key)
+            raise
+
+
+send_client = SendClient()
@@ -0,0 +1,179 @@
+"""In-process metrics rendered in the Prometheus text format
+
+Stages of the bot (geocoding, county lookups, Graph API sends, ...) are
+wrapped in `timed` spans, aggregated per stage into one latency
+histogram: recording a span is a perf_counter() call, a bisect and a
+locked increment, cheap enough to leave on. Counters count events, and
+collected metrics read a value from a component (Ex- a queue depth, a
+cache hit counter) when /metrics is scraped.
+
+A share of the webhook events, set by METRICS_SAMPLE_RATE (0 by
+default), is also traced: the spans of a sampled event are logged as one
+line when it is done.
+"""
+import bisect
+import logging
+import os
+import random
+import threading
+import time
+
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 0))
+# Seconds, upper bounds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """Cumulative histogram of observed values, per label value
+
+    :param name: metric name
+    :param help: description of the metric
+    :param label: name of the label told apart (Ex- stage)
+    :param buckets: sorted upper bounds of the buckets
+    """
+
+    def __init__(self, name, help, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Bucket counts, then the +Inf count, then the sum
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[position] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for label_value, values in series:
+            label = '{}="{}"'.format(self.label, label_value)
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), values):
+                count += bucket_count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound, count))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, label, values[-1]))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label, count))
+        return lines
+
+
+class Registry(object):
+    """Counters, collected metrics and stage histograms of the process"""
+
+    def __init__(self):
+        self.stages = Histogram('covideye_stage_seconds', 'Latency of the bot stages', 'stage')
+        self._counters = {}
+        self._collected = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, help=''):
+        """Adds to a counter, created on first use"""
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = [0, help]
+            counter[0] += amount
+
+    def collect(self, name, function, help='', kind='gauge'):
+        """Registers a metric read from function() on every scrape
+
+        :param kind: gauge, or counter for values that only go up
+        """
+        with self._lock:
+            self._collected[name] = (function, help, kind)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            counters = sorted((name, list(counter)) for name, counter in self._counters.items())
+            collected = sorted(self._collected.items())
+        for name, (value, help) in counters:
+            lines += ['# HELP {} {}'.format(name, help), '# TYPE {} counter'.format(name),
+                      '{} {}'.format(name, value)]
+        for name, (function, help, kind) in collected:
+            try:
+                value = function()
+            except Exception:
+                logger.exception('Failed to collect %s', name)
+                continue
+            lines += ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind),
+                      '{} {}'.format(name, value)]
+        lines += self.stages.render()
+        return '\n'.join(lines) + '\n'
+
+
+class _TraceLocal(threading.local):
+    # Spans of the traced work running on this thread, None if untraced
+    spans = None
+
+
+registry = Registry()
+_local = _TraceLocal()
+
+
+class Span(object):
+    """Times the enclosed block as one span of a stage
+
+    :param stage: stage name, the label of the latency histogram
+    """
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        registry.stages.observe(self.stage, elapsed)
+        spans = _local.spans
+        if spans is not None:
+            spans.append((self.stage, elapsed))
+
+
+timed = Span
+
+
+def traced(generator, name, sample_rate=None):
+    """Runs a handler generator, tracing its spans when sampled
+
+    Spans are collected in a thread local, set around each step since
+    the steps of a paused generator may run on different threads.
+
+    :param generator: generator yielding delays, as dispatcher handlers
+    :param name: name of the traced work, logged (Ex- the event kind)
+    :param sample_rate: share of calls traced, METRICS_SAMPLE_RATE if None
+    """
+    sample_rate = METRICS_SAMPLE_RATE if sample_rate is None else sample_rate
+    if not sample_rate or random.random() >= sample_rate:
+        return (yield from generator)
+    spans = []
+    start = time.perf_counter()
+    try:
+        while True:
+            _local.spans = spans
+            try:
+                delay = next(generator)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                _local.spans = None
+            yield delay
+    finally:
+        elapsed = time.perf_counter() - start
+        logger.info('%s took %.1f ms: %s', name, elapsed * 1e3,
+                    ', '.join('{} {:.1f} ms'.format(stage, seconds * 1e3) for stage, seconds in spans) or 'no spans')
@@ -0,0 +1,206 @@
+"""Safer nearby county ranking for every US county at once
+
+For each county the ranker picks the neighbor, within 1 or 2 hops of the
+adjacency graph, with the lowest value of a metric:
+
+    cases       cumulative cases
+    per_capita  cumulative cases per 100,000 residents
+    growth7     new cases of the last 7 days relative to the cases before
+    growth14    same over 14 days
+
+Tables are recomputed with NumPy after every county data refresh, so a
+lookup is one array read.
+
+Regenerate the bundled population table from the census county
+estimates (co-est2019-alldata.csv) with:
+python ranking.py co-est2019-alldata.csv [county_population.csv]
+"""
+import csv
+import logging
+import os
+import sys
+import threading
+
+from adjacency import load_adjacency
+
+from county_data import county_store
+
+import numpy as np
+
+POPULATION_PATH = os.environ.get(
+    'COUNTY_POPULATION_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'county_population.csv'))
+METRICS = ('cases', 'per_capita', 'growth7', 'growth14')
+SAFER_COUNTY_METRIC = os.environ.get('SAFER_COUNTY_METRIC', 'cases')
+SAFER_COUNTY_HOPS = int(os.environ.get('SAFER_COUNTY_HOPS', 1))
+
+logger = logging.getLogger(__name__)
+
+
+def two_hop_graph(indptr, indices):
+    """Builds the CSR graph of counties at most 2 hops away
+
+    :returns: (indptr, indices) tuple, neighbors sorted, self excluded
+    """
+    n = len(indptr) - 1
+    degree = np.diff(indptr)
+    sources = np.repeat(np.arange(n), degree)
+    # Neighbors of every neighbor, laid out edge after edge
+    hop_degree = degree[indices]
+    hop_starts = np.repeat(indptr[:-1][indices], hop_degree)
+    hop_offsets = np.arange(hop_degree.sum()) - np.repeat(np.cumsum(hop_degree) - hop_degree, hop_degree)
+    all_sources = np.concatenate((sources, np.repeat(sources, hop_degree)))
+    all_targets = np.concatenate((indices, indices[hop_starts + hop_offsets]))
+    keep = all_sources != all_targets
+    keys = np.unique(all_sources[keep].astype(np.int64) * n + all_targets[keep])
+    two_hop_indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(keys // n, minlength=n), out=two_hop_indptr[1:])
+    return two_hop_indptr, (keys % n).astype(np.int32)
+
+
+def segment_argmin(indptr, indices, values):
+    """Finds the neighbor with the lowest value for every node
+
+    :param values: float array, NaN for unknown values
+    :returns: int32 array of neighbor indices, -1 when no neighbor has
+        a known value
+    """
+    n = len(indptr) - 1
+    neighbor_values = values[indices]
+    neighbor_values = np.where(np.isnan(neighbor_values), np.inf, neighbor_values)
+    segments = np.repeat(np.arange(n), np.diff(indptr))
+    order = np.lexsort((neighbor_values, segments))
+    best = np.full(n, -1, dtype=np.int32)
+    nonempty = np.flatnonzero(np.diff(indptr))
+    first = order[indptr[:-1][nonempty]]
+    found = np.isfinite(neighbor_values[first])
+    best[nonempty[found]] = indices[first[found]]
+    return best
+
+
+def load_population(adjacency, path=POPULATION_PATH):
+    """Loads the population of every county of the adjacency graph
+
+    :returns: float64 array aligned with adjacency.fips, NaN for
+        counties without a population or if the table is missing
+    """
+    population = np.full(len(adjacency), np.nan)
+    if not os.path.exists(path):
+        logger.warning('%s not found, per capita metrics are unavailable', path)
+        return population
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            index = adjacency.index_of_fips(row['fips'])
+            if index is not None:
+                population[index] = float(row['population'])
+    return population
+
+
+class SaferCountyRanker(object):
+    """Precomputed safest neighbor of every county
+
+    :param adjacency: CountyAdjacency graph
+    :param population: population array aligned with adjacency.fips
+    """
+
+    def __init__(self, adjacency, population=None):
+        self.adjacency = adjacency
+        if population is None:
+            population = np.full(len(adjacency), np.nan)
+        self.population = population
+        self.graphs = {1: (adjacency.indptr, adjacency.indices),
+                       2: two_hop_graph(adjacency.indptr, adjacency.indices)}
+        self.values = {}
+        self.tables = {}
+
+    def _aligned(self, snapshot, column_values):
+        """Reorders snapshot column values to the adjacency order"""
+        aligned = np.full(len(self.adjacency), np.nan)
+        if not len(snapshot.fips):
+            return aligned
+        columns = np.searchsorted(snapshot.fips, self.adjacency.fips)
+        columns = np.minimum(columns, len(snapshot.fips) - 1)
+        known = snapshot.fips[columns] == self.adjacency.fips
+        aligned[known] = column_values[columns[known]]
+        return aligned
+
+    def metric_values(self, snapshot):
+        """Computes every metric for every county
+
+        :returns: dict of metric name to float array aligned with
+            adjacency.fips, NaN where the value is unknown
+        """
+        n_days = len(snapshot.dates)
+        if not n_days:
+            return {metric: np.full(len(self.adjacency), np.nan) for metric in METRICS}
+        latest = snapshot.cases[-1].astype(np.float64)
+        values = {'cases': self._aligned(snapshot, latest)}
+        values['per_capita'] = values['cases'] / self.population * 100000
+        for days in (7, 14):
+            before = snapshot.cases[-1 - days].astype(np.float64) if n_days > days else np.zeros_like(latest)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                growth = np.where(before > 0, (latest - before) / before, np.nan)
+            values['growth{}'.format(days)] = self._aligned(snapshot, growth)
+        return values
+
+    def rank(self, snapshot):
+        """Recomputes the safest neighbor tables from a county snapshot"""
+        values = self.metric_values(snapshot)
+        tables = {}
+        for metric in METRICS:
+            for hops, (indptr, indices) in self.graphs.items():
+                tables[(metric, hops)] = segment_argmin(indptr, indices, values[metric])
+        self.values = values
+        self.tables = tables
+
+    def safest(self, index, metric=SAFER_COUNTY_METRIC, hops=SAFER_COUNTY_HOPS):
+        """Returns the safest neighbor index of a county
+
+        :param index: county index in the adjacency graph
+        :param metric: one of METRICS
+        :param hops: 1 for direct neighbors, 2 to include their neighbors
+        :returns: neighbor index or None if not ranked or no neighbor
+            has data
+        """
+        table = self.tables.get((metric, hops))
+        if table is None or table[index] < 0:
+            return None
+        return int(table[index])
+
+
+_ranker = None
+_ranker_lock = threading.Lock()
+
+
+def load_ranker():
+    """Returns the process-wide ranker, ranking again on every refresh"""
+    global _ranker
+    if _ranker is None:
+        with _ranker_lock:
+            if _ranker is None:
+                adjacency = load_adjacency()
+                ranker = SaferCountyRanker(adjacency, load_population(adjacency))
+                county_store.add_listener(ranker.rank)
+                _ranker = ranker
+    return _ranker
+
+
+def build_population(source, path=POPULATION_PATH):
+    """Writes the fips,population table from the census county estimates"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(source, newline='', encoding='latin-1') as f, open(path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(['fips', 'population'])
+        for row in csv.DictReader(f):
+            if int(row['SUMLEV']) == 50:
+                # Some copies of the file drop the leading zeros
+                writer.writerow(['{:02d}{:03d}'.format(int(row['STATE']), int(row['COUNTY'])),
+                                 row['POPESTIMATE2019']])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.exit('usage: python ranking.py co-est2019-alldata.csv [county_population.csv]')
+    build_population(*sys.argv[1:])
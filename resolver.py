@@ -0,0 +1,172 @@
+"""Offline ZIP code and coordinates to county resolution
+
+ZIP codes are looked up in the bundled data/zip_county.csv (zip,fips)
+and coordinates, such as Messenger location pins, in a grid index over
+the county boundaries of data/county_boundaries.json (GeoJSON features
+with a GEOID property, Ex- the census cartographic boundary file). The
+Maps API is then only needed for free-form addresses.
+
+Regenerate the ZIP table from a ZIP-county crosswalk, keeping for each
+ZIP the county with the largest share: the HUD USPS crosswalk saved as
+CSV (ZIP, COUNTY, RES_RATIO) or the census ZCTA one (zip, fips, weight):
+python resolver.py ZIP_COUNTY.csv [zip_county.csv]
+
+Regenerate the boundaries from the census cartographic boundary file
+converted to GeoJSON (Ex- ogr2ogr -f GeoJSON), simplified to about 500 m:
+python resolver.py cb_2016_us_county_500k.json [county_boundaries.json]
+"""
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+
+from geocode import normalize_address
+
+import numpy as np
+
+from spatial import GridIndex, geometry_polygons, simplify_ring
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+ZIP_COUNTY_PATH = os.path.join(DATA_DIR, 'zip_county.csv')
+COUNTY_BOUNDARIES_PATH = os.path.join(DATA_DIR, 'county_boundaries.json')
+# Degrees, about the size of a county
+GRID_CELL_SIZE = 0.5
+# Degrees, largest error of the simplified boundaries (about 500 m)
+SIMPLIFY_TOLERANCE = 0.005
+# Column names of the ZIP, county and share of the known crosswalks
+CROSSWALK_COLUMNS = (('ZIP', 'COUNTY', 'RES_RATIO'), ('zip', 'fips', 'weight'))
+
+logger = logging.getLogger(__name__)
+
+
+class CountyResolver(object):
+    """Resolves ZIP codes and coordinates to county FIPS codes
+
+    :param zip_counties: dict of 5 digit ZIP code to county FIPS code
+    :param boundaries: GridIndex of county FIPS codes, or None
+    """
+
+    def __init__(self, zip_counties=None, boundaries=None):
+        self.zip_counties = zip_counties or {}
+        self.boundaries = boundaries
+
+    @classmethod
+    def load(cls, zip_path=ZIP_COUNTY_PATH, boundaries_path=COUNTY_BOUNDARIES_PATH):
+        """Loads the bundled tables, skipping the missing ones"""
+        zip_counties = {}
+        if os.path.exists(zip_path):
+            with open(zip_path, newline='') as f:
+                zip_counties = {row['zip']: int(row['fips']) for row in csv.DictReader(f)}
+        else:
+            logger.warning('%s not found, ZIP codes are geocoded online', zip_path)
+        boundaries = None
+        if os.path.exists(boundaries_path):
+            with open(boundaries_path) as f:
+                features = json.load(f)['features']
+            boundaries = GridIndex(GRID_CELL_SIZE)
+            for feature in features:
+                boundaries.add(int(feature['properties']['GEOID']), geometry_polygons(feature['geometry']))
+        else:
+            logger.warning('%s not found, location pins are not resolved', boundaries_path)
+        return cls(zip_counties, boundaries)
+
+    def resolve_zip(self, zip_code):
+        """Returns the FIPS code of the county of a ZIP code or None"""
+        return self.zip_counties.get(zip_code)
+
+    def resolve_address(self, address):
+        """Returns the FIPS code of an address if it is a ZIP code
+
+        :param address: free text user input (Ex- '75201', '75201-1234')
+        :returns: county FIPS code or None if the address isn't a known
+            ZIP code
+        """
+        key = normalize_address(address)
+        if key.startswith('zip:'):
+            return self.resolve_zip(key[4:])
+        return None
+
+    def resolve_point(self, lat, lng):
+        """Returns the FIPS code of the county containing a point or None"""
+        if self.boundaries is None:
+            return None
+        counties = self.boundaries.query_point(lng, lat)
+        return counties[0] if counties else None
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def load_resolver():
+    """Returns the process-wide resolver, loading it on first call"""
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = CountyResolver.load()
+    return _resolver
+
+
+def build_zip_counties(source, path=ZIP_COUNTY_PATH):
+    """Writes the zip,fips table from a ZIP-county crosswalk"""
+    best = {}
+    with open(source, newline='', encoding='latin-1') as f:
+        reader = csv.DictReader(f)
+        for columns in CROSSWALK_COLUMNS:
+            if set(columns) <= set(reader.fieldnames):
+                zip_column, county_column, share_column = columns
+                break
+        else:
+            raise ValueError('{} is not a known ZIP-county crosswalk'.format(source))
+        for row in reader:
+            zip_code = row[zip_column]
+            share = float(row[share_column] or 0)
+            if zip_code not in best or share > best[zip_code][0]:
+                best[zip_code] = (share, row[county_column])
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(['zip', 'fips'])
+        for zip_code in sorted(best):
+            writer.writerow([zip_code.zfill(5), best[zip_code][1].zfill(5)])
+
+
+def build_boundaries(source, path=COUNTY_BOUNDARIES_PATH, tolerance=SIMPLIFY_TOLERANCE):
+    """Writes simplified county boundaries from a GeoJSON file
+
+    Rings that simplify to nothing (Ex- small islands) are dropped,
+    except the largest outline of a county, kept as is.
+
+    :param source: GeoJSON feature collection with a GEOID property
+    """
+    with open(source) as f:
+        features = json.load(f)['features']
+    simplified = []
+    for feature in features:
+        polygons = geometry_polygons(feature['geometry'])
+        coordinates = []
+        for polygon in polygons:
+            rings = [simplify_ring(ring, tolerance) for ring in polygon]
+            if len(rings[0]) >= 4:
+                coordinates.append([np.round(ring, 4).tolist() for ring in rings if len(ring) >= 4])
+        if not coordinates:
+            largest = max(polygons, key=lambda polygon: len(polygon[0]))
+            coordinates.append([np.round(largest[0], 4).tolist()])
+        simplified.append({'type': 'Feature', 'properties': {'GEOID': feature['properties']['GEOID']},
+                           'geometry': {'type': 'MultiPolygon', 'coordinates': coordinates}})
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as out:
+        json.dump({'type': 'FeatureCollection', 'features': simplified}, out, separators=(',', ':'))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.exit('usage: python resolver.py ZIP_COUNTY.csv [zip_county.csv]\n'
+                 '       python resolver.py counties.json [county_boundaries.json]')
+    if sys.argv[1].endswith(('.json', '.geojson')):
+        build_boundaries(*sys.argv[1:])
+    else:
+        build_zip_counties(*sys.argv[1:])
@@ -0,0 +1,302 @@
+"""Point queries over the hourly risk grids of mint_json
+
+mint_json/mint0.json ... mint23.json are GeoJSON FeatureCollections of
+square grid cells with `risk` and `num` properties, one file per hour of
+the day. The cells of all hours lie on one regular grid, so they are
+converted once to a raster cube file:
+
+    magic      8 bytes   b'CVRISK1\\0'
+    origin     float64[2]                   lng, lat of the grid corner
+    cell_size  float64[2]                   cell width, height in degrees
+    shape      int64[3]                     hours, rows, cols
+    risk       float32[hours, rows, cols]   NaN where there is no cell
+    num        uint16[hours, rows, cols]
+
+It is opened with numpy.memmap, so a lookup is index arithmetic and
+processes reading the same file share its pages. Where cells overlap,
+the first feature of the hour wins, as in the GeoJSON index.
+
+The grids cover Beijing, so their hours are China Standard Time
+(UTC+8, no daylight saving); grid_hour() gives the current one.
+
+Rebuild the cube with: python risk.py [mint_json] [risk_cube.bin]
+"""
+import collections
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from spatial import GridIndex, geometry_polygons
+
+MINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mint_json')
+RISK_CUBE_PATH = os.environ.get(
+    'RISK_CUBE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'risk_cube.bin'))
+MAGIC = b'CVRISK1\0'
+HEADER_SIZE = len(MAGIC) + 56
+HOURS = 24
+# Hours between UTC and the local time of the grids
+RISK_UTC_OFFSET = float(os.environ.get('RISK_UTC_OFFSET', 8))
+# Degrees, about two risk cells wide
+GRID_CELL_SIZE = 0.01
+KM_PER_DEGREE = 111.32
+
+RiskCell = collections.namedtuple('RiskCell', ['risk', 'num', 'lat', 'lng'])
+
+logger = logging.getLogger(__name__)
+
+
+def grid_hour(now=None):
+    """Returns the hour of the day in the time zone of the grids
+
+    :param now: POSIX timestamp, the current time if None
+    """
+    now = time.time() if now is None else now
+    return int((now + RISK_UTC_OFFSET * 3600) // 3600 % HOURS)
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Approximate distance between two close points (equirectangular)"""
+    x = (lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    return math.hypot(x, lat2 - lat1) * KM_PER_DEGREE
+
+
+class RiskIndex(object):
+    """Spatial index of the risk cells of every hour, read from GeoJSON
+
+    :param grids: list of 24 GridIndex of RiskCell, one per hour
+    """
+
+    def __init__(self, grids):
+        self.grids = grids
+
+    @classmethod
+    def load(cls, directory=MINT_DIR):
+        """Loads mint0.json to mint23.json, missing hours stay empty"""
+        grids = []
+        for hour in range(HOURS):
+            grid = GridIndex(GRID_CELL_SIZE)
+            path = os.path.join(directory, 'mint{}.json'.format(hour))
+            if os.path.exists(path):
+                with open(path) as f:
+                    features = json.load(f)['features']
+                for feature in features:
+                    properties = feature['properties']
+                    # Index every square of a MultiPolygon as its own cell
+                    for polygon in geometry_polygons(feature['geometry']):
+                        center = polygon[0][:-1].mean(axis=0)
+                        cell = RiskCell(properties['risk'], properties['num'], float(center[1]), float(center[0]))
+                        grid.add(cell, [polygon])
+            grids.append(grid)
+        return cls(grids)
+
+    def risk_at(self, lat, lng, hour):
+        """Finds the risk cell containing a point at an hour of the day
+
+        :returns: RiskCell or None if the point is outside the grid
+        """
+        cells = self.grids[hour % HOURS].query_point(lng, lat)
+        return cells[0] if cells else None
+
+    def lowest_risk_nearby(self, lat, lng, hour, radius_km=1.0, limit=3):
+        """Finds the lowest risk cells around a point at an hour of the day
+
+        :param radius_km: search radius around the point
+        :param limit: maximum number of cells returned
+        :returns: list of (RiskCell, distance_km) pairs, lowest risk
+            first, then closest first
+        """
+        grid = self.grids[hour % HOURS]
+        lat_delta = radius_km / KM_PER_DEGREE
+        lng_delta = lat_delta / max(math.cos(math.radians(lat)), 1e-6)
+        found = []
+        for position in grid.candidates(lng - lng_delta, lat - lat_delta, lng + lng_delta, lat + lat_delta):
+            cell = grid.items[position]
+            distance = distance_km(lat, lng, cell.lat, cell.lng)
+            if distance <= radius_km:
+                found.append((cell, distance))
+        found.sort(key=lambda pair: (pair[0].risk, pair[1]))
+        return found[:limit]
+
+
+class RiskCube(object):
+    """Read-only, memory-mapped view of a risk cube file
+
+    Answers the same queries as RiskIndex.
+
+    :param path: cube file written by write_cube
+    """
+
+    def __init__(self, path=RISK_CUBE_PATH):
+        raw = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(raw[:len(MAGIC)]) != MAGIC:
+            raise ValueError('{} is not a risk cube'.format(path))
+        self.origin_lng, self.origin_lat, self.cell_width, self.cell_height = (
+            float(value) for value in np.frombuffer(raw, dtype=np.float64, count=4, offset=len(MAGIC)))
+        self.shape = tuple(int(value) for value in np.frombuffer(raw, dtype=np.int64, count=3,
+                                                                 offset=len(MAGIC) + 32))
+        size = self.shape[0] * self.shape[1] * self.shape[2]
+        self.risk = np.frombuffer(raw, dtype=np.float32, count=size, offset=HEADER_SIZE).reshape(self.shape)
+        self.num = np.frombuffer(raw, dtype=np.uint16, count=size,
+                                 offset=HEADER_SIZE + 4 * size).reshape(self.shape)
+
+    def _cell(self, hour, row, col):
+        # float32 keeps about 7 significant digits of the risk
+        return RiskCell(round(float(self.risk[hour, row, col]), 6), int(self.num[hour, row, col]),
+                        self.origin_lat + (int(row) + 0.5) * self.cell_height,
+                        self.origin_lng + (int(col) + 0.5) * self.cell_width)
+
+    def risk_at(self, lat, lng, hour):
+        """Finds the risk cell containing a point at an hour of the day
+
+        :returns: RiskCell or None if the point is outside the grid
+        """
+        row = math.floor((lat - self.origin_lat) / self.cell_height)
+        col = math.floor((lng - self.origin_lng) / self.cell_width)
+        if not (0 <= row < self.shape[1] and 0 <= col < self.shape[2]):
+            return None
+        hour %= HOURS
+        if math.isnan(self.risk[hour, row, col]):
+            return None
+        return self._cell(hour, row, col)
+
+    def lowest_risk_nearby(self, lat, lng, hour, radius_km=1.0, limit=3):
+        """Finds the lowest risk cells around a point at an hour of the day
+
+        :param radius_km: search radius around the point
+        :param limit: maximum number of cells returned
+        :returns: list of (RiskCell, distance_km) pairs, lowest risk
+            first, then closest first
+        """
+        lat_delta = radius_km / KM_PER_DEGREE
+        lng_delta = lat_delta / max(math.cos(math.radians(lat)), 1e-6)
+        first_row = max(math.floor((lat - lat_delta - self.origin_lat) / self.cell_height), 0)
+        last_row = min(math.floor((lat + lat_delta - self.origin_lat) / self.cell_height) + 1, self.shape[1])
+        first_col = max(math.floor((lng - lng_delta - self.origin_lng) / self.cell_width), 0)
+        last_col = min(math.floor((lng + lng_delta - self.origin_lng) / self.cell_width) + 1, self.shape[2])
+        if first_row >= last_row or first_col >= last_col:
+            return []
+        hour %= HOURS
+        window = self.risk[hour, first_row:last_row, first_col:last_col]
+        rows, cols = np.nonzero(~np.isnan(window))
+        rows += first_row
+        cols += first_col
+        center_lat = self.origin_lat + (rows + 0.5) * self.cell_height
+        center_lng = self.origin_lng + (cols + 0.5) * self.cell_width
+        x = (center_lng - lng) * np.cos(np.radians((center_lat + lat) / 2))
+        distances = np.hypot(x, center_lat - lat) * KM_PER_DEGREE
+        inside = distances <= radius_km
+        rows, cols, distances = rows[inside], cols[inside], distances[inside]
+        order = np.lexsort((distances, self.risk[hour, rows, cols]))[:limit]
+        return [(self._cell(hour, rows[i], cols[i]), float(distances[i])) for i in order]
+
+
+def detect_grid(index):
+    """Finds the regular grid the cells of a RiskIndex lie on
+
+    :returns: (origin_lng, origin_lat, cell_width, cell_height, rows, cols)
+    :raises ValueError: if the cells aren't aligned on one grid
+    """
+    boxes = np.array([box for grid in index.grids for box in grid.boxes], dtype=np.float64)
+    if not len(boxes):
+        raise ValueError('No risk cells to convert')
+    cell_width = float(np.median(boxes[:, 2] - boxes[:, 0]))
+    cell_height = float(np.median(boxes[:, 3] - boxes[:, 1]))
+    origin_lng = float(boxes[:, 0].min())
+    origin_lat = float(boxes[:, 1].min())
+    cols = (boxes[:, 0] - origin_lng) / cell_width
+    rows = (boxes[:, 1] - origin_lat) / cell_height
+    spans = np.concatenate([(boxes[:, 2] - boxes[:, 0]) / cell_width, (boxes[:, 3] - boxes[:, 1]) / cell_height])
+    if (np.abs(cols - np.round(cols)).max() > 1e-6 or np.abs(rows - np.round(rows)).max() > 1e-6 or
+            np.abs(spans - 1).max() > 1e-6):
+        raise ValueError('Risk cells are not on a regular grid')
+    return (origin_lng, origin_lat, cell_width, cell_height,
+            int(np.round(rows).max()) + 1, int(np.round(cols).max()) + 1)
+
+
+def write_cube(index, path=RISK_CUBE_PATH):
+    """Writes the cells of a RiskIndex as a cube, atomically replacing `path`"""
+    origin_lng, origin_lat, cell_width, cell_height, rows, cols = detect_grid(index)
+    risk = np.full((HOURS, rows, cols), np.nan, dtype=np.float32)
+    num = np.zeros((HOURS, rows, cols), dtype=np.uint16)
+    for hour, grid in enumerate(index.grids):
+        # Reversed, so the first of overlapping cells is written last
+        for cell, box in reversed(list(zip(grid.items, grid.boxes))):
+            row = int(round((box[1] - origin_lat) / cell_height))
+            col = int(round((box[0] - origin_lng) / cell_width))
+            risk[hour, row, col] = cell.risk
+            num[hour, row, col] = cell.num
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([origin_lng, origin_lat, cell_width, cell_height], dtype=np.float64).tobytes())
+        f.write(np.array([HOURS, rows, cols], dtype=np.int64).tobytes())
+        f.write(risk.tobytes())
+        f.write(num.tobytes())
+    os.replace(tmp_path, path)
+
+
+def verify(cube, index):
+    """Checks a cube answers like the GeoJSON index at every cell center
+
+    :returns: number of cells answered differently
+    """
+    mismatches = 0
+    for hour, grid in enumerate(index.grids):
+        for cell in grid.items:
+            expected = index.risk_at(cell.lat, cell.lng, hour)
+            found = cube.risk_at(cell.lat, cell.lng, hour)
+            if (found is None or abs(found.risk - expected.risk) > 1e-6 or found.num != expected.num or
+                    abs(found.lat - expected.lat) > 1e-9 or abs(found.lng - expected.lng) > 1e-9):
+                mismatches += 1
+    return mismatches
+
+
+def convert(directory=MINT_DIR, path=RISK_CUBE_PATH):
+    """Builds the cube file from the mint_json GeoJSON files and checks it
+
+    :raises ValueError: if the cube doesn't match the GeoJSON cells
+    """
+    index = RiskIndex.load(directory)
+    write_cube(index, path)
+    mismatches = verify(RiskCube(path), index)
+    if mismatches:
+        raise ValueError('{} cells of {} differ from {}'.format(mismatches, path, directory))
+
+
+_risk_index = None
+_risk_index_lock = threading.Lock()
+
+
+def load_risk_index(path=RISK_CUBE_PATH):
+    """Returns the process-wide risk cube, loading it on first call
+
+    The cube is bundled and never written at runtime: if the file is
+    missing, the grids are read from mint_json into a RiskIndex until
+    the cube is rebuilt with python risk.py.
+    """
+    global _risk_index
+    if _risk_index is None:
+        with _risk_index_lock:
+            if _risk_index is None:
+                if os.path.exists(path):
+                    _risk_index = RiskCube(path)
+                else:
+                    logger.error('%s not found, run python risk.py to build it', path)
+                    _risk_index = RiskIndex.load(MINT_DIR)
+    return _risk_index
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3:
+        sys.exit('usage: python risk.py [mint_json] [risk_cube.bin]')
+    convert(*sys.argv[1:])
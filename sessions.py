@@ -0,0 +1,187 @@
+"""Per-user conversation state
+
+Two backends share the same interface:
+
+    memory  LRU ordered dict with a TTL, for a single process
+    sqlite  SQLite file, shared by every worker process of a host
+
+Select one with SESSION_STORE=memory|sqlite (SESSIONS_DB sets the
+SQLite file).
+"""
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+SESSION_STORE = os.environ.get('SESSION_STORE', 'memory')
+SESSIONS_DB = os.environ.get('SESSIONS_DB', 'sessions.db')
+# Seconds of inactivity after which a conversation is forgotten
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 7 * 86400))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 100000))
+# Expired records are swept in bulk once every this many saves
+EXPIRE_EVERY = 1000
+FIELDS = ('dest_type', 'orig_county', 'state', 'state_short',
+          'safer_county', 'subscribe_county')
+
+
+class SessionRecord(object):
+    """Conversation state of one user
+
+    Supports item access like the dict it replaces: reading a field that
+    was never set raises KeyError, get() returns a default instead.
+    """
+
+    __slots__ = FIELDS + ('updated_at',)
+
+    def __init__(self, *values, updated_at=0.0):
+        for field, value in zip(FIELDS, values or (None,) * len(FIELDS)):
+            setattr(self, field, value)
+        self.updated_at = updated_at
+
+    def __getitem__(self, field):
+        value = getattr(self, field) if field in FIELDS else None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in FIELDS:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def get(self, field, default=None):
+        value = getattr(self, field) if field in FIELDS else None
+        return default if value is None else value
+
+    def values(self):
+        return tuple(getattr(self, field) for field in FIELDS)
+
+
+class MemorySessionStore(object):
+    """In-process store evicting the least recently used records
+
+    :param max_entries: records kept before evicting the oldest
+    :param ttl: seconds after which an untouched record expires
+    """
+
+    def __init__(self, max_entries=SESSION_MAX_ENTRIES, ttl=SESSION_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._saves = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, recipient_id):
+        """Returns the record of a user, a new one if missing or expired"""
+        now = time.time()
+        with self._lock:
+            record = self._records.get(recipient_id)
+            if record is not None and now - record.updated_at < self.ttl:
+                record.updated_at = now
+                self._records.move_to_end(recipient_id)
+                return record
+        return SessionRecord(updated_at=now)
+
+    def save(self, recipient_id, record):
+        """Stores the record of a user"""
+        record.updated_at = time.time()
+        with self._lock:
+            self._records[recipient_id] = record
+            self._records.move_to_end(recipient_id)
+            while len(self._records) > self.max_entries:
+                self._records.popitem(last=False)
+            self._saves += 1
+            sweep = self._saves % EXPIRE_EVERY == 0
+        if sweep:
+            self.expire()
+
+    def expire(self):
+        """Removes every expired record
+
+        Records are kept in last use order, so this stops at the first
+        one still valid.
+
+        :returns: number of records removed
+        """
+        deadline = time.time() - self.ttl
+        removed = 0
+        with self._lock:
+            while self._records:
+                recipient_id, record = next(iter(self._records.items()))
+                if record.updated_at >= deadline:
+                    break
+                del self._records[recipient_id]
+                removed += 1
+        return removed
+
+
+class SQLiteSessionStore(object):
+    """Store shared by processes through a SQLite file
+
+    :param path: SQLite database file
+    :param ttl: seconds after which an untouched record expires
+    """
+
+    def __init__(self, path=SESSIONS_DB, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._saves = 0
+
+    def _connect(self):
+        # One connection per thread and process, never shared after a fork
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS sessions (recipient_id TEXT PRIMARY KEY, {}, '
+                       'updated_at REAL NOT NULL) WITHOUT ROWID'.format(', '.join(FIELDS)))
+            db.execute('CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def get(self, recipient_id):
+        """Returns the record of a user, a new one if missing or expired"""
+        now = time.time()
+        row = self._connect().execute(
+            'SELECT {}, updated_at FROM sessions WHERE recipient_id = ? AND updated_at >= ?'.format(
+                ', '.join(FIELDS)), (recipient_id, now - self.ttl)).fetchone()
+        if row is None:
+            return SessionRecord(updated_at=now)
+        return SessionRecord(*row[:-1], updated_at=row[-1])
+
+    def save(self, recipient_id, record):
+        """Stores the record of a user"""
+        record.updated_at = time.time()
+        self._connect().execute(
+            'INSERT OR REPLACE INTO sessions VALUES (?, {}, ?)'.format(', '.join('?' * len(FIELDS))),
+            (recipient_id,) + record.values() + (record.updated_at,))
+        self._saves += 1
+        if self._saves % EXPIRE_EVERY == 0:
+            self.expire()
+
+    def expire(self):
+        """Removes every expired record
+
+        :returns: number of records removed
+        """
+        return self._connect().execute('DELETE FROM sessions WHERE updated_at < ?',
+                                       (time.time() - self.ttl,)).rowcount
+
+
+def create_session_store(kind=SESSION_STORE):
+    """Creates the session store selected by SESSION_STORE"""
+    if kind == 'sqlite':
+        return SQLiteSessionStore()
+    if kind == 'memory':
+        return MemorySessionStore()
+    raise ValueError('Unknown session store {!r}'.format(kind))
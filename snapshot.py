@@ -0,0 +1,266 @@
+"""Columnar snapshot of the NYT county case history
+
+The snapshot is one binary file holding, for every day and every county,
+the cumulative cases and deaths as int32 columns:
+
+    magic      8 bytes   b'CVSNAP1\\0'
+    n_days     int64
+    n_counties int64
+    dates      int32[n_days]                days since 1970-01-01
+    fips       int32[n_counties]            sorted ascending
+    cases      int32[n_days, n_counties]
+    deaths     int32[n_days, n_counties]
+
+It is opened with numpy.memmap, so processes reading the same file share
+its pages instead of each parsing the CSV. ChangeDetector tells apart the
+counties whose latest numbers changed from one snapshot to the next.
+
+Convert a CSV with: python snapshot.py us-counties.csv county_snapshot.bin
+"""
+import csv
+import datetime
+import os
+import sys
+import threading
+
+import numpy as np
+
+SNAPSHOT_PATH = os.environ.get(
+    'COUNTY_SNAPSHOT_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'county_snapshot.bin'))
+MAGIC = b'CVSNAP1\0'
+HEADER_SIZE = len(MAGIC) + 16
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def _day_number(date):
+    """Converts a YYYY-MM-DD string to days since 1970-01-01"""
+    year, month, day = date.split('-')
+    return (datetime.date(int(year), int(month), int(day)) - EPOCH).days
+
+
+class SnapshotBuilder(object):
+    """Accumulates NYT rows (sorted by date) into dense per-day arrays
+
+    Counties missing from a day keep their numbers of the previous day.
+    Rows without a FIPS code (Ex- New York City, Unknown) are skipped.
+    """
+
+    def __init__(self):
+        self._columns = {}
+        self._dates = []
+        self._cases = np.zeros((64, 4096), dtype=np.int32)
+        self._deaths = np.zeros((64, 4096), dtype=np.int32)
+
+    def _grow(self, days, counties):
+        rows, cols = self._cases.shape
+        if days <= rows and counties <= cols:
+            return
+        while rows < days:
+            rows *= 2
+        while cols < counties:
+            cols *= 2
+        shape = (rows, cols)
+        for name in ('_cases', '_deaths'):
+            grown = np.zeros(shape, dtype=np.int32)
+            old = getattr(self, name)
+            grown[:old.shape[0], :old.shape[1]] = old
+            setattr(self, name, grown)
+
+    def add_rows(self, rows):
+        """Adds CSV rows of the NYT us-counties format
+
+        :param rows: iterable of [date, county, state, fips, cases, deaths]
+        """
+        for row in rows:
+            self.add_row(row)
+
+    def add_row(self, row):
+        """Adds one [date, county, state, fips, cases, deaths] CSV row"""
+        if len(row) < 6 or not row[3] or row[0] == 'date':
+            return
+        try:
+            fips = int(row[3])
+            cases = int(row[4])
+            deaths = int(row[5] or 0)
+            day = _day_number(row[0])
+        except ValueError:
+            return
+        if not self._dates or day > self._dates[-1]:
+            self._grow(len(self._dates) + 1, len(self._columns))
+            if self._dates:
+                n = len(self._dates)
+                self._cases[n] = self._cases[n - 1]
+                self._deaths[n] = self._deaths[n - 1]
+            self._dates.append(day)
+        column = self._columns.get(fips)
+        if column is None:
+            column = self._columns[fips] = len(self._columns)
+            self._grow(len(self._dates), len(self._columns))
+        # Rows of an older day only happen in a corrected file, which
+        # is rebuilt from scratch, so they update the current day
+        self._cases[len(self._dates) - 1, column] = cases
+        self._deaths[len(self._dates) - 1, column] = deaths
+
+    def write(self, path):
+        """Writes the snapshot, atomically replacing `path`"""
+        n_days = len(self._dates)
+        fips = np.fromiter(self._columns.keys(), dtype=np.int32, count=len(self._columns))
+        columns = np.fromiter(self._columns.values(), dtype=np.int64, count=len(self._columns))
+        order = np.argsort(fips)
+        fips = fips[order]
+        columns = columns[order]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.array([n_days, len(fips)], dtype=np.int64).tobytes())
+            f.write(np.array(self._dates, dtype=np.int32).tobytes())
+            f.write(fips.tobytes())
+            f.write(np.ascontiguousarray(self._cases[:n_days][:, columns]).tobytes())
+            f.write(np.ascontiguousarray(self._deaths[:n_days][:, columns]).tobytes())
+        os.replace(tmp_path, path)
+
+
+class CountySnapshot(object):
+    """Read-only, memory-mapped view of a snapshot file
+
+    :param path: snapshot file written by SnapshotBuilder.write
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        raw = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(raw[:len(MAGIC)]) != MAGIC:
+            raise ValueError('{} is not a county snapshot'.format(path))
+        n_days, n_counties = np.frombuffer(raw, dtype=np.int64, count=2, offset=len(MAGIC))
+        n_days = int(n_days)
+        n_counties = int(n_counties)
+        offset = HEADER_SIZE
+        self.dates = np.frombuffer(raw, dtype=np.int32, count=n_days, offset=offset)
+        offset += 4 * n_days
+        self.fips = np.frombuffer(raw, dtype=np.int32, count=n_counties, offset=offset)
+        offset += 4 * n_counties
+        size = n_days * n_counties
+        self.cases = np.frombuffer(raw, dtype=np.int32, count=size,
+                                   offset=offset).reshape(n_days, n_counties)
+        offset += 4 * size
+        self.deaths = np.frombuffer(raw, dtype=np.int32, count=size,
+                                    offset=offset).reshape(n_days, n_counties)
+
+    def index_of(self, fips):
+        """Finds the column of a county
+
+        :param fips: county FIPS code as int or string (Ex- '48113')
+        :returns: column index or None if the county is unknown
+        """
+        fips = int(fips)
+        column = int(np.searchsorted(self.fips, fips))
+        if column < len(self.fips) and self.fips[column] == fips:
+            return column
+        return None
+
+    @property
+    def last_date(self):
+        """Date of the most recent day (Ex- 2020-04-12)"""
+        if not len(self.dates):
+            return None
+        return (EPOCH + datetime.timedelta(days=int(self.dates[-1]))).isoformat()
+
+    def new_cases_all(self, days=7):
+        """New cases of every county over the last `days` days
+
+        :returns: int32 array aligned with self.fips
+        """
+        if not len(self.dates):
+            return np.zeros(len(self.fips), dtype=np.int32)
+        start = self.cases[-1 - days] if len(self.dates) > days else 0
+        return self.cases[-1] - start
+
+    def new_cases(self, fips, days=7):
+        """New cases of a county over the last `days` days
+
+        :returns: number of new cases or None if the county is unknown
+        """
+        column = self.index_of(fips)
+        if column is None or not len(self.dates):
+            return None
+        start = self.cases[-1 - days, column] if len(self.dates) > days else 0
+        return int(self.cases[-1, column] - start)
+
+    def growth_rate(self, fips, days=7):
+        """Growth of the cumulative cases of a county over `days` days
+
+        :returns: fraction (Ex- 0.25 for +25%) or None if the county is
+            unknown or had no cases `days` days ago
+        """
+        column = self.index_of(fips)
+        if column is None or len(self.dates) <= days:
+            return None
+        before = int(self.cases[-1 - days, column])
+        if not before:
+            return None
+        return (int(self.cases[-1, column]) - before) / before
+
+
+class ChangeDetector(object):
+    """County data listener finding the counties whose numbers moved
+
+    It keeps a copy of the latest cases and deaths of every county and,
+    on each new snapshot, compares all counties at once: the cost of a
+    refresh doesn't depend on how the changed counties are used.
+
+    :param callback: function called as callback(fips) with the int32
+        array of changed county FIPS codes, when there is any; None to
+        only call update()
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._fips = None
+        self._latest = None
+        self._lock = threading.Lock()
+
+    def __call__(self, snapshot):
+        changed = self.update(snapshot)
+        if changed is not None and len(changed):
+            self.callback(changed)
+
+    def update(self, snapshot):
+        """Remembers the latest numbers of a snapshot
+
+        :param snapshot: CountySnapshot
+        :returns: int32 array of the FIPS codes of the counties that are
+            new or whose cases or deaths changed since the previous
+            snapshot, None for the first snapshot seen
+        """
+        fips = np.array(snapshot.fips)
+        if len(snapshot.dates):
+            latest = np.stack((snapshot.cases[-1], snapshot.deaths[-1]))
+        else:
+            latest = np.zeros((2, len(fips)), dtype=np.int32)
+        with self._lock:
+            previous_fips, previous = self._fips, self._latest
+            self._fips, self._latest = fips, latest
+        if previous_fips is None:
+            return None
+        if not len(previous_fips):
+            return fips
+        columns = np.minimum(np.searchsorted(previous_fips, fips), len(previous_fips) - 1)
+        moved = (previous_fips[columns] != fips) | (previous[:, columns] != latest).any(axis=0)
+        return fips[moved]
+
+
+def convert(csv_path, snapshot_path=SNAPSHOT_PATH):
+    """Builds a snapshot file from a NYT us-counties.csv file"""
+    builder = SnapshotBuilder()
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        builder.add_rows(csv.reader(f))
+    builder.write(snapshot_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.exit('usage: python snapshot.py us-counties.csv [snapshot.bin]')
+    convert(*sys.argv[1:])
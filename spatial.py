@@ -0,0 +1,144 @@
+"""Grid-bucketed spatial index over polygons
+
+Each polygon's bounding box is registered in every grid cell it covers,
+so a point query only looks at the polygons of one cell, then keeps the
+ones whose rings contain the point (ray casting, vectorized with NumPy).
+Coordinates are (x, y) = (longitude, latitude) as in GeoJSON.
+"""
+import math
+
+import numpy as np
+
+
+def ring_contains(ring, x, y):
+    """Tells whether a point is inside a closed ring
+
+    :param ring: float array of shape (n, 2), first point repeated last
+    """
+    x0 = ring[:-1, 0]
+    y0 = ring[:-1, 1]
+    x1 = ring[1:, 0]
+    y1 = ring[1:, 1]
+    crosses = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return bool(np.count_nonzero(crosses & (x < x_cross)) % 2)
+
+
+def polygon_contains(polygon, x, y):
+    """Tells whether a point is inside a polygon and outside its holes
+
+    :param polygon: list of rings, the outer ring first
+    """
+    if not ring_contains(polygon[0], x, y):
+        return False
+    return not any(ring_contains(hole, x, y) for hole in polygon[1:])
+
+
+def geometry_polygons(geometry):
+    """Converts a GeoJSON Polygon or MultiPolygon to lists of ring arrays"""
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError('Unsupported geometry {}'.format(geometry['type']))
+    return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon] for polygon in polygons]
+
+
+def simplify_ring(ring, tolerance):
+    """Simplifies a closed ring with the Douglas-Peucker algorithm
+
+    :param ring: float array of shape (n, 2), first point repeated last
+    :param tolerance: largest distance, in degrees, of a dropped point
+        to the simplified outline
+    :returns: float array of the kept points, first point repeated last
+    """
+    keep = np.zeros(len(ring), dtype=bool)
+    keep[0] = keep[-1] = True
+    # The first and last points are the same: split the ring at the
+    # point farthest from them
+    far = int(np.argmax(((ring - ring[0]) ** 2).sum(axis=1)))
+    keep[far] = True
+    spans = [(0, far), (far, len(ring) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+        dx, dy = ring[end] - ring[start]
+        points = ring[start + 1:end] - ring[start]
+        length = math.hypot(dx, dy)
+        if length:
+            distances = np.abs(dx * points[:, 1] - dy * points[:, 0]) / length
+        else:
+            distances = np.hypot(points[:, 0], points[:, 1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            spans += [(start, middle), (middle, end)]
+    return ring[keep]
+
+
+class GridIndex(object):
+    """Point and box queries over polygons bucketed in a regular grid
+
+    :param cell_size: grid cell size in degrees, about the size of the
+        indexed polygons works best
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.items = []
+        self.boxes = []
+        self.polygons = []
+        self._cells = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cell(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def add(self, item, polygons):
+        """Indexes an item covering one or more polygons
+
+        :param item: value returned by queries
+        :param polygons: list of polygons, each a list of ring arrays as
+            returned by geometry_polygons
+        """
+        points = np.concatenate([polygon[0] for polygon in polygons])
+        box = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+        position = len(self.items)
+        self.items.append(item)
+        self.boxes.append(box)
+        self.polygons.append(polygons)
+        min_x, min_y = self._cell(box[0], box[1])
+        max_x, max_y = self._cell(box[2], box[3])
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                self._cells.setdefault((cell_x, cell_y), []).append(position)
+
+    def candidates(self, min_x, min_y, max_x, max_y):
+        """Returns the positions of items whose box intersects a box"""
+        first_x, first_y = self._cell(min_x, min_y)
+        last_x, last_y = self._cell(max_x, max_y)
+        found = set()
+        for cell_x in range(first_x, last_x + 1):
+            for cell_y in range(first_y, last_y + 1):
+                for position in self._cells.get((cell_x, cell_y), ()):
+                    box = self.boxes[position]
+                    if box[0] <= max_x and box[2] >= min_x and box[1] <= max_y and box[3] >= min_y:
+                        found.add(position)
+        return sorted(found)
+
+    def query_point(self, x, y):
+        """Returns the items whose polygons contain a point"""
+        found = []
+        for position in self._cells.get(self._cell(x, y), ()):
+            box = self.boxes[position]
+            if not (box[0] <= x <= box[2] and box[1] <= y <= box[3]):
+                continue
+            if any(polygon_contains(polygon, x, y) for polygon in self.polygons[position]):
+                found.append(self.items[position])
+        return found
@@ -0,0 +1,244 @@
+"""Durable one-time notification scheduler
+
+Subscriptions are stored in SQLite, so pending notifications survive
+restarts and dyno cycling. They are not sent on a timer: after each
+county data refresh, the counties whose numbers changed are stamped with
+a new generation number in the database, and each subscription carries
+the generation of its county when it was made. The scheduler thread
+claims the subscriptions older than the latest change of their county,
+in one transaction (so several processes sharing the database never
+notify the same subscriber twice). They are grouped by county and
+handed to the notify callback once per county on a bounded thread pool,
+then deleted, so each one-time token is used once. Subscribers of a
+county whose numbers didn't move since they subscribed are not even
+read.
+
+Nothing pending is kept in process memory: a process started later,
+such as a respawned worker, only finds the changes nobody notified.
+"""
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import registry, timed
+
+SUBSCRIPTIONS_DB = os.environ.get('SUBSCRIPTIONS_DB', 'subscriptions.db')
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 4))
+# Seconds a claimed subscription is reserved before another process may
+# claim it again, if the claiming process died before notifying
+CLAIM_LEASE = 600
+# Counties per claim query, below SQLite's limit of bound parameters
+CLAIM_CHUNK = 500
+
+Subscription = collections.namedtuple(
+    'Subscription', ['id', 'recipient_id', 'token', 'county', 'state_short', 'due_at'])
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionScheduler(object):
+    """Persistent scheduler of county-grouped one-time notifications
+
+    :param notify: function called as notify(county, subscriptions) with
+        the claimed subscriptions of one county, returning those notified
+    :param path: SQLite database file
+    :param workers: number of counties notified concurrently
+    """
+
+    def __init__(self, notify=None, path=SUBSCRIPTIONS_DB, workers=NOTIFY_WORKERS):
+        self.notify = notify
+        self.path = path
+        self.workers = workers
+        self._db = None
+        self._pid = None
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        # Set when changes were recorded since the last claim
+        self._signalled = False
+        self._thread = None
+
+    def _connect(self):
+        # Never shared after a fork: the master may record the changes
+        # of its first refresh before forking the workers
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS subscriptions (
+                id INTEGER PRIMARY KEY,
+                recipient_id TEXT NOT NULL,
+                token TEXT NOT NULL,
+                county TEXT NOT NULL,
+                state_short TEXT,
+                due_at REAL NOT NULL,
+                generation INTEGER NOT NULL DEFAULT 0)''')
+            if 'generation' not in [row[1] for row in db.execute('PRAGMA table_info(subscriptions)')]:
+                db.execute('ALTER TABLE subscriptions ADD COLUMN generation INTEGER NOT NULL DEFAULT 0')
+            db.execute('CREATE INDEX IF NOT EXISTS subscriptions_due_at ON subscriptions (due_at)')
+            db.execute('CREATE INDEX IF NOT EXISTS subscriptions_county ON subscriptions (county)')
+            # Generation of the latest change of each county
+            db.execute('''CREATE TABLE IF NOT EXISTS county_changes (
+                county TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL)''')
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def start(self):
+        """Opens the database and starts the scheduler thread"""
+        with self._db_lock:
+            if self._thread:
+                return
+            self._connect()
+            self._thread = threading.Thread(target=self._run, name='subscriptions')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def subscribe(self, recipient_id, token, county, state_short, delay=0):
+        """Stores a one-time notification request
+
+        The subscriber is notified on the first change of the county
+        numbers recorded after it subscribed.
+
+        :param recipient_id: user id
+        :param token: one time notif token issued when the user subscribed
+        :param county: county name (Ex- Dallas County, TX)
+        :param state_short: state name in short (Ex- TX)
+        :param delay: seconds before a change may be notified
+        """
+        with self._db_lock:
+            self._connect().execute(
+                'INSERT INTO subscriptions (recipient_id, token, county, state_short, due_at, generation) '
+                'VALUES (?, ?, ?, ?, ?, COALESCE((SELECT generation FROM county_changes WHERE county = ?), 0))',
+                (recipient_id, token, county, state_short, time.time() + delay, county))
+
+    def pending(self):
+        """Returns the number of subscriptions not notified yet"""
+        with self._db_lock:
+            return self._connect().execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0]
+
+    def counties_changed(self, counties):
+        """Records that the numbers of some counties changed
+
+        The changes get the next generation number, so the subscriptions
+        made before are due and the later ones wait for the next change.
+        The scheduler thread of this process, if started, is woken up.
+
+        :param counties: iterable of county names (Ex- Dallas County, TX)
+        """
+        counties = list(counties)
+        if not counties:
+            return
+        with self._db_lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                generation = db.execute('SELECT COALESCE(MAX(generation), 0) + 1 FROM county_changes').fetchone()[0]
+                db.executemany('INSERT OR REPLACE INTO county_changes (county, generation) VALUES (?, ?)',
+                               [(county, generation) for county in counties])
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        with self._wakeup:
+            self._signalled = True
+            self._wakeup.notify()
+
+    def pending_counties(self, now=None):
+        """Finds the counties with subscriptions due for a change
+
+        :returns: list of county names (Ex- Dallas County, TX)
+        """
+        now = time.time() if now is None else now
+        with self._db_lock:
+            rows = self._connect().execute(
+                'SELECT DISTINCT subscriptions.county FROM subscriptions JOIN county_changes '
+                'ON county_changes.county = subscriptions.county '
+                'WHERE subscriptions.generation < county_changes.generation AND due_at <= ?', (now,)).fetchall()
+        return [row[0] for row in rows]
+
+    def claim_counties(self, counties, now=None):
+        """Reserves the due subscriptions of some counties for this process
+
+        Only the subscriptions made before the latest change of their
+        county are due. Subscriptions claimed by another process less
+        than CLAIM_LEASE seconds ago are left out.
+
+        :param counties: list of county names (Ex- Dallas County, TX)
+        :returns: list of Subscription
+        """
+        now = time.time() if now is None else now
+        rows = []
+        with self._db_lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                for start in range(0, len(counties), CLAIM_CHUNK):
+                    chunk = counties[start:start + CLAIM_CHUNK]
+                    where = ('county IN ({}) AND due_at <= ? AND generation < COALESCE(('
+                             'SELECT generation FROM county_changes WHERE county_changes.county = '
+                             'subscriptions.county), 0)').format(', '.join('?' * len(chunk)))
+                    rows += db.execute(
+                        'SELECT id, recipient_id, token, county, state_short, due_at '
+                        'FROM subscriptions WHERE ' + where, chunk + [now]).fetchall()
+                    db.execute('UPDATE subscriptions SET due_at = ? WHERE ' + where,
+                               [now + CLAIM_LEASE] + chunk + [now])
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        return [Subscription(*row) for row in rows]
+
+    def complete(self, subscriptions):
+        """Removes notified subscriptions"""
+        with self._db_lock:
+            self._connect().executemany('DELETE FROM subscriptions WHERE id = ?',
+                                        [(subscription.id,) for subscription in subscriptions])
+
+    def notify_counties(self, counties, executor=None):
+        """Notifies the subscribers of some counties, one notify call per county"""
+        by_county = collections.defaultdict(list)
+        for subscription in self.claim_counties(sorted(counties)):
+            by_county[subscription.county].append(subscription)
+        if not by_county:
+            return
+        if executor is None:
+            for county, subscriptions in by_county.items():
+                self._notify_county(county, subscriptions)
+        else:
+            list(executor.map(self._notify_county, by_county.keys(), by_county.values()))
+
+    def _notify_county(self, county, subscriptions):
+        try:
+            with timed('notify_county'):
+                notified = self.notify(county, subscriptions)
+        except Exception:
+            logger.exception('Failed to notify %d subscribers of %s', len(subscriptions), county)
+            notified = []
+        # The claim lease of the others expires and they are retried by
+        # the next claim after it, keeping their generation
+        failed = len(subscriptions) - len(notified)
+        if failed:
+            logger.warning('%d of %d subscribers of %s were not notified', failed, len(subscriptions), county)
+            registry.inc('covideye_notify_failures_total', failed,
+                         help='Subscriptions whose notification failed and is retried')
+        if notified:
+            self.complete(notified)
+            registry.inc('covideye_notifications_total', len(notified), help='Subscriptions notified')
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        while True:
+            # Also on start, for the changes recorded by another process
+            # (Ex- the gunicorn master) or left by one that exited
+            try:
+                self.notify_counties(self.pending_counties(), executor)
+            except Exception:
+                logger.exception('Failed to notify the subscribers of the changed counties')
+            with self._wakeup:
+                while not self._signalled:
+                    self._wakeup.wait()
+                self._signalled = False
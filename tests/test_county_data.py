@@ -0,0 +1,199 @@
+"""Incremental refreshes of CountyCaseStore against a local stand-in
+
+The stand-in serves one CSV body with an ETag and honours the
+If-None-Match and Range headers the way raw.githubusercontent.com does.
+"""
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+from county_data import CountyCaseStore, OVERLAP_BYTES
+
+HEADER = b'date,county,state,fips,cases,deaths\n'
+# Longer than the overlap tail, so a Range request starts past byte 0
+DAY_1 = b''.join(b'2020-04-01,County%d,Texas,%d,1,0\n' % (number, 48001 + 2 * number)
+                 for number in range(20))
+DAY_1 += (b'2020-04-01,Dallas,Texas,48113,10,1\n'
+          b'2020-04-01,Rockwall,Texas,48397,5,0\n')
+DAY_2 = (b'2020-04-02,Dallas,Texas,48113,12,1\n'
+         b'2020-04-02,Rockwall,Texas,48397,7,1\n')
+
+
+class CsvHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.body
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        status = 200
+        headers = {'ETag': etag}
+        range_header = self.headers.get('Range')
+        if range_header:
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(body)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))
+            body = body[start:]
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), CsvHandler)
+    server.body = HEADER + DAY_1
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def store(server, tmp_path):
+    url = 'http://127.0.0.1:{}/us-counties.csv'.format(server.server_address[1])
+    store = CountyCaseStore(url=url, refresh_interval=0,
+                            snapshot_path=str(tmp_path / 'county_snapshot.bin'))
+    store.load()
+    server.requests.clear()
+    return store
+
+
+def test_load_indexes_latest_rows(store):
+    assert store.loaded
+    assert store.lookup('Texas', 'Dallas County').cases == 10
+    assert store.lookup_fips('48397').cases == 5
+    assert store.snapshot.last_date == '2020-04-01'
+
+
+def test_append_fetches_only_new_bytes(server, store):
+    start = len(HEADER + DAY_1) - OVERLAP_BYTES
+    server.body += DAY_2
+
+    assert store.update()
+
+    assert server.requests[0]['Range'] == 'bytes={}-'.format(start)
+    assert store.lookup('Texas', 'Dallas County').cases == 12
+    assert store.lookup_fips('48397').deaths == 1
+    assert store.snapshot.last_date == '2020-04-02'
+    assert int(store.snapshot.cases[-1, store.snapshot.index_of(48397)]) == 7
+
+
+def test_partial_trailing_line_waits_for_its_end(server, store):
+    line = b'2020-04-02,Dallas,Texas,48113,12,1\n'
+    server.body += line[:20]
+
+    store.update()
+    assert store.lookup_fips('48113').cases == 10
+    assert store._offset == len(HEADER + DAY_1)
+
+    server.body += line[20:]
+    assert store.update()
+    assert store.lookup_fips('48113').cases == 12
+    assert store._offset == len(HEADER + DAY_1 + line)
+
+
+def test_rewritten_file_is_reloaded(server, store):
+    server.body = HEADER + DAY_1.replace(b'48113,10,1', b'48113,11,2') + DAY_2.replace(b'48113,12', b'48113,13')
+
+    assert store.update()
+
+    # The overlap no longer matches: one Range request, then a full one
+    assert 'Range' in server.requests[0]
+    assert 'Range' not in server.requests[1]
+    assert store.lookup_fips('48113').cases == 13
+    assert store.lookup_fips('48397').cases == 7
+    assert store._offset == len(server.body)
+
+
+def test_unchanged_file_is_not_modified(server, store):
+    assert not store.update()
+    assert server.requests[0]['If-None-Match']
+    assert store.lookup_fips('48113').cases == 10
+
+
+def test_shorter_file_is_reloaded(server, store):
+    server.body = HEADER + DAY_1[DAY_1.index(b'2020-04-01,Dallas'):]
+
+    assert store.update()
+
+    # 416 to the Range request, then a full download
+    assert 'Range' in server.requests[0]
+    assert 'Range' not in server.requests[1]
+    assert store.lookup_fips('48113').cases == 10
+    assert store.lookup_fips('48001') is None
+    assert store._offset == len(server.body)
+
+
+@pytest.fixture
+def follower(server, store):
+    """Second store sharing the snapshot file of `store`"""
+    follower = CountyCaseStore(url=store.url, refresh_interval=0, snapshot_path=store.snapshot_path)
+    yield follower
+    follower.stop()
+
+
+def test_one_process_refreshes_the_others_follow(server, store, follower):
+    refreshed = []
+    followed = []
+    store.add_change_listener(refreshed.append)
+    follower.add_change_listener(followed.append)
+    store.start()
+    follower.start()
+
+    # The follower maps the snapshot of the refreshing store, no download
+    assert not server.requests
+    assert follower.lookup_fips('48113').cases == 10
+    assert not follower.follow()
+
+    server.body += DAY_2
+    assert store.update()
+    assert follower.follow()
+
+    assert len(server.requests) == 1
+    record = follower.lookup_fips('48113')
+    assert (record.date, record.cases, record.deaths) == ('2020-04-02', 12, 1)
+    assert follower.snapshot.last_date == '2020-04-02'
+    # Only the process that refreshed reports the changed counties
+    assert [sorted(fips.tolist()) for fips in refreshed] == [[48113, 48397]]
+    assert followed == []
+    store.stop()
+
+
+def test_follower_takes_over_the_refreshes(server, store, follower):
+    changed = []
+    follower.add_change_listener(changed.append)
+    store.start()
+    follower.start()
+    store.stop()
+
+    follower.start()
+    server.body += DAY_2
+    follower.refresh()
+
+    assert follower.lookup('Texas', 'Dallas County').cases == 12
+    # Compared with the snapshot it followed, not with nothing
+    assert [fips.tolist() for fips in changed] == [[48113, 48397]]
+    assert store.follow()
+    assert store.lookup_fips('48397').cases == 7
@@ -0,0 +1,104 @@
+"""EventDispatcher ordering, back pressure and coalescing
+
+Handlers record what they ran in a list; events and a blocking handler
+hold the workers where a test needs them, so no test depends on timing.
+"""
+import threading
+import time
+
+import pytest
+
+from dispatch import EventDispatcher, QueueFull
+
+
+def wait_idle(dispatcher, timeout=5):
+    """Waits until no recipient has work running, paused or queued"""
+    deadline = time.time() + timeout
+    while dispatcher.stats()['recipients']:
+        assert time.time() < deadline, 'dispatcher still busy: {}'.format(dispatcher.stats())
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def ran():
+    return []
+
+
+@pytest.fixture
+def blocker(ran):
+    """Handler holding its worker until released, with a started event"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(name):
+        started.set()
+        release.wait(5)
+        ran.append(name)
+
+    block.started = started
+    block.release = release
+    yield block
+    release.set()
+
+
+def test_recipient_order_is_kept_across_a_pause(ran):
+    dispatcher = EventDispatcher(workers=1)
+
+    def paused(name):
+        ran.append(name + ' before')
+        yield 0.2
+        ran.append(name + ' after')
+
+    dispatcher.submit_many([('a', paused, 'a1'), ('a', ran.append, 'a2'), ('b', ran.append, 'b1')])
+    wait_idle(dispatcher)
+
+    assert [name for name in ran if name.startswith('a')] == ['a1 before', 'a1 after', 'a2']
+    # The only worker was freed during the pause and served recipient b
+    assert ran.index('b1') < ran.index('a1 after')
+
+
+def test_full_queue_rejects_the_whole_batch(ran, blocker):
+    dispatcher = EventDispatcher(workers=1, max_pending=2)
+    dispatcher.submit('a', blocker, 'a1')
+    assert blocker.started.wait(5)
+    dispatcher.submit_many([('a', ran.append, 'a2'), ('b', ran.append, 'b1')])
+
+    with pytest.raises(QueueFull):
+        dispatcher.submit_many([('c', ran.append, 'c1')])
+    assert dispatcher.stats()['pending'] == 2
+
+    blocker.release.set()
+    wait_idle(dispatcher)
+    assert sorted(ran) == ['a1', 'a2', 'b1']
+
+
+def test_newer_call_replaces_queued_calls_of_its_kind(ran, blocker):
+    dispatcher = EventDispatcher(workers=1)
+    dispatcher.submit('z', blocker, 'z1')
+    assert blocker.started.wait(5)
+
+    dispatcher.submit_many([('a', ran.append, 'search x'), ('a', ran.append, 'other'),
+                            ('a', ran.append, 'untagged'), ('b', ran.append, 'search b')],
+                           [('search', 'x'), ('other', 1), None, ('search', 'b')])
+    dispatcher.submit_many([('a', ran.append, 'search y')], [('search', 'y')])
+    assert dispatcher.stats()['coalesced'] == 1
+    assert dispatcher.stats()['pending'] == 4
+
+    blocker.release.set()
+    wait_idle(dispatcher)
+    assert [name for name in ran if name != 'search b'] == ['z1', 'other', 'untagged', 'search y']
+    assert 'search b' in ran
+
+
+def test_call_with_the_running_tag_is_dropped(ran, blocker):
+    dispatcher = EventDispatcher(workers=2)
+    dispatcher.submit_many([('a', blocker, 'search x')], [('search', 'x')])
+    assert blocker.started.wait(5)
+
+    dispatcher.submit_many([('a', ran.append, 'search x again')], [('search', 'x')])
+    dispatcher.submit_many([('a', ran.append, 'search y')], [('search', 'y')])
+    assert dispatcher.stats()['coalesced'] == 1
+
+    blocker.release.set()
+    wait_idle(dispatcher)
+    assert ran == ['search x', 'search y']
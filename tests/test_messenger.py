@@ -0,0 +1,155 @@
+"""SendClient retries against a local fake Graph API server
+
+The fake server answers each call from a script of responses set by the
+test, then with a success, and records the calls it received.
+"""
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+from messenger import SendClient, SendError
+
+
+class GraphHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        path = urllib.parse.urlparse(self.path).path
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            call = json.loads(body)
+        else:
+            call = {key: values[0] for key, values in urllib.parse.parse_qs(body).items()}
+        self.server.calls.append((path, call))
+        script = self.server.script.get(path)
+        if script:
+            status, headers, answer = script.pop(0)
+        elif path == '/v2.6':
+            status, headers, answer = 200, {}, [{'code': 200, 'body': '{}'} for _ in json.loads(call['batch'])]
+        else:
+            status, headers, answer = 200, {}, {'recipient_id': '1', 'message_id': 'm'}
+        if callable(answer):
+            answer = answer(call)
+        data = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), GraphHandler)
+    server.calls = []
+    server.script = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    url = 'http://127.0.0.1:{}/v2.6'.format(server.server_address[1])
+    return SendClient(access_token='token', graph_url=url, max_retries=3, backoff=0.001, max_backoff=0.01)
+
+
+def rate_limit_error(code=613):
+    return {'error': {'message': 'Calls to this api have exceeded the rate limit.', 'code': code}}
+
+
+def test_429_is_retried_after_retry_after(server, client):
+    server.script['/v2.6/me/messages'] = [(429, {'Retry-After': '1'}, rate_limit_error())]
+
+    start = time.time()
+    result = client.send_text_message('1', 'hello')
+
+    assert time.time() - start >= 1
+    assert result['message_id'] == 'm'
+    assert len(server.calls) == 2
+    assert server.calls[0] == server.calls[1]
+
+
+def test_graph_rate_limit_code_is_retried(server, client):
+    server.script['/v2.6/me/messages'] = [(400, {}, rate_limit_error(4)), (500, {}, {})]
+
+    assert client.send_text_message('1', 'hello')['message_id'] == 'm'
+    assert len(server.calls) == 3
+
+
+def test_other_errors_are_not_retried(server, client):
+    server.script['/v2.6/me/messages'] = [(400, {}, {'error': {'message': 'Invalid user', 'code': 100}})]
+
+    with pytest.raises(SendError):
+        client.send_text_message('1', 'hello')
+    assert len(server.calls) == 1
+
+
+def test_batch_retries_only_the_failed_sends(server, client):
+    def first_round(call):
+        batch = json.loads(call['batch'])
+        answers = [{'code': 200, 'body': json.dumps({'message_id': str(i)})} for i in range(len(batch))]
+        answers[1] = {'code': 400, 'body': json.dumps(rate_limit_error())}
+        answers[2] = None
+        answers[3] = {'code': 400, 'body': json.dumps({'error': {'message': 'Invalid user', 'code': 100}})}
+        return answers
+
+    server.script['/v2.6'] = [(200, {}, first_round)]
+    payloads = [{'recipient': {'id': str(i)}, 'message': {'text': 'hi'}} for i in range(5)]
+
+    results = client.send_batch(payloads)
+
+    assert [payload for payload, _ in results] == payloads
+    assert results[0][1] == {'message_id': '0'}
+    assert results[1][1] == {} and results[2][1] == {}
+    assert isinstance(results[3][1], SendError)
+    assert results[4][1] == {'message_id': '4'}
+    # The second round only carries the rate limited and timed out sends
+    assert len(server.calls) == 2
+    retried = json.loads(server.calls[1][1]['batch'])
+    assert [urllib.parse.unquote(item['body']) for item in retried] == [
+        'recipient={}&message={}'.format(json.dumps(payloads[position]['recipient']),
+                                         json.dumps(payloads[position]['message']))
+        for position in (1, 2)]
+
+
+def test_apply_setting_is_posted_once(server, client):
+    setting = {'setting_type': 'greeting', 'greeting': {'text': 'Hi'}}
+
+    client.apply_setting(setting)
+    assert client.apply_setting(dict(reversed(list(setting.items())))) is None
+
+    assert len(server.calls) == 1
+    assert server.calls[0] == ('/v2.6/me/thread_settings', setting)
+
+
+def test_failed_setting_is_posted_again(server, client):
+    setting = {'setting_type': 'greeting', 'greeting': {'text': 'Hi'}}
+    server.script['/v2.6/me/thread_settings'] = [(403, {}, {'error': {'message': 'Denied', 'code': 10}})]
+
+    with pytest.raises(SendError):
+        client.apply_setting(setting)
+    client.apply_setting(setting)
+
+    assert len(server.calls) == 2
+
+
+def test_repeated_sender_action_is_skipped(server, client):
+    client.send_action('1', 'typing_on')
+    client.send_action('1', 'typing_on')
+    client.send_text_message('1', 'hello')
+    client.send_action('1', 'typing_on')
+
+    actions = [call.get('sender_action') for _, call in server.calls]
+    assert actions == ['typing_on', None, 'typing_on']
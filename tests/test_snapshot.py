@@ -0,0 +1,69 @@
+"""ChangeDetector over snapshots written by SnapshotBuilder"""
+import pytest
+
+from snapshot import ChangeDetector, CountySnapshot, SnapshotBuilder
+
+DAY_1 = [['2020-04-01', 'Dallas', 'Texas', '48113', '10', '1'],
+         ['2020-04-01', 'Rockwall', 'Texas', '48397', '5', '0'],
+         ['2020-04-01', 'Collin', 'Texas', '48085', '8', '0']]
+
+
+@pytest.fixture
+def write(tmp_path):
+    """Writes the snapshot of some CSV rows and maps it"""
+    paths = iter(str(tmp_path / 'snapshot{}.bin'.format(number)) for number in range(100))
+
+    def write(rows):
+        builder = SnapshotBuilder()
+        builder.add_rows(rows)
+        path = next(paths)
+        builder.write(path)
+        return CountySnapshot(path)
+
+    return write
+
+
+def test_first_snapshot_is_the_baseline(write):
+    detector = ChangeDetector()
+
+    assert detector.update(write(DAY_1)) is None
+    assert detector.update(write(DAY_1)).tolist() == []
+
+
+def test_moved_counties_are_found(write):
+    detector = ChangeDetector()
+    detector.update(write(DAY_1))
+
+    changed = detector.update(write(DAY_1 + [['2020-04-02', 'Dallas', 'Texas', '48113', '12', '1'],
+                                             ['2020-04-02', 'Rockwall', 'Texas', '48397', '5', '1'],
+                                             ['2020-04-02', 'Collin', 'Texas', '48085', '8', '0']]))
+
+    # Cases or deaths moved, a county with the same numbers is left out
+    assert changed.tolist() == [48113, 48397]
+
+
+def test_new_counties_are_found(write):
+    detector = ChangeDetector()
+    detector.update(write(DAY_1[:1]))
+
+    changed = detector.update(write(DAY_1))
+
+    assert changed.tolist() == [48085, 48397]
+
+
+def test_everything_is_new_after_an_empty_snapshot(write):
+    detector = ChangeDetector()
+    detector.update(write([]))
+
+    assert detector.update(write(DAY_1)).tolist() == [48085, 48113, 48397]
+
+
+def test_callback_gets_only_changes(write):
+    calls = []
+    detector = ChangeDetector(calls.append)
+
+    detector(write(DAY_1))
+    detector(write(DAY_1))
+    detector(write(DAY_1 + [['2020-04-02', 'Collin', 'Texas', '48085', '9', '0']]))
+
+    assert [fips.tolist() for fips in calls] == [[48085]]
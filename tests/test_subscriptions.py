@@ -0,0 +1,134 @@
+"""SubscriptionScheduler claims against a SQLite file of a test directory
+
+Two schedulers on the same file stand for two processes sharing the
+database, such as two gunicorn workers or a worker respawned later.
+"""
+import threading
+import time
+
+import pytest
+
+from subscriptions import CLAIM_LEASE, SubscriptionScheduler
+
+DALLAS = 'Dallas County, TX'
+ROCKWALL = 'Rockwall County, TX'
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'subscriptions.db')
+
+
+@pytest.fixture
+def scheduler(path):
+    return SubscriptionScheduler(path=path)
+
+
+def recipients(subscriptions):
+    return sorted(subscription.recipient_id for subscription in subscriptions)
+
+
+def test_only_subscriptions_before_a_change_are_due(scheduler):
+    scheduler.subscribe('user-1', 'token-1', DALLAS, 'TX')
+    scheduler.subscribe('user-r', 'token-r', ROCKWALL, 'TX')
+    assert scheduler.claim_counties([DALLAS, ROCKWALL]) == []
+
+    scheduler.counties_changed([DALLAS])
+    # Subscribed after the numbers changed: waits for the next change
+    scheduler.subscribe('user-2', 'token-2', DALLAS, 'TX')
+
+    assert scheduler.pending_counties() == [DALLAS]
+    assert recipients(scheduler.claim_counties([DALLAS, ROCKWALL])) == ['user-1']
+
+
+def test_claimed_subscriptions_are_leased(scheduler):
+    scheduler.subscribe('user-1', 'token-1', DALLAS, 'TX')
+    scheduler.counties_changed([DALLAS])
+    now = time.time()
+
+    assert recipients(scheduler.claim_counties([DALLAS], now)) == ['user-1']
+    assert scheduler.claim_counties([DALLAS], now + 1) == []
+    assert scheduler.pending_counties(now + 1) == []
+    assert recipients(scheduler.claim_counties([DALLAS], now + CLAIM_LEASE + 1)) == ['user-1']
+
+
+def test_two_processes_claim_each_subscription_once(scheduler, path):
+    other = SubscriptionScheduler(path=path)
+    for number in range(200):
+        scheduler.subscribe('user-{}'.format(number), 'token-{}'.format(number), DALLAS, 'TX')
+    scheduler.counties_changed([DALLAS])
+    claimed = {}
+    ready = threading.Barrier(2)
+
+    def claim(name, process):
+        ready.wait()
+        claimed[name] = [subscription.id for subscription in process.claim_counties([DALLAS])]
+
+    threads = [threading.Thread(target=claim, args=(name, process))
+               for name, process in (('first', scheduler), ('second', other))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not set(claimed['first']) & set(claimed['second'])
+    assert len(claimed['first']) + len(claimed['second']) == 200
+
+
+def test_failed_notification_keeps_the_token(path):
+    def notify(county, subscriptions):
+        return [subscription for subscription in subscriptions if subscription.recipient_id == 'user-1']
+
+    scheduler = SubscriptionScheduler(notify, path=path)
+    scheduler.subscribe('user-1', 'token-1', DALLAS, 'TX')
+    scheduler.subscribe('user-2', 'token-2', DALLAS, 'TX')
+    scheduler.counties_changed([DALLAS])
+
+    scheduler.notify_counties([DALLAS])
+
+    assert scheduler.pending() == 1
+    retried = scheduler.claim_counties([DALLAS], time.time() + CLAIM_LEASE + 1)
+    assert [(subscription.recipient_id, subscription.token) for subscription in retried] == [('user-2', 'token-2')]
+
+
+def test_later_process_only_finds_changes_nobody_notified(path):
+    notified = []
+
+    def notify(county, subscriptions):
+        notified.extend(subscription.recipient_id for subscription in subscriptions)
+        return subscriptions
+
+    scheduler = SubscriptionScheduler(notify, path=path)
+    scheduler.subscribe('user-1', 'token-1', DALLAS, 'TX')
+    scheduler.counties_changed([DALLAS])
+    scheduler.notify_counties(scheduler.pending_counties())
+    scheduler.subscribe('user-2', 'token-2', DALLAS, 'TX')
+
+    # A worker started now, with no change since user-2 subscribed
+    respawned = SubscriptionScheduler(notify, path=path)
+    assert respawned.pending_counties() == []
+    respawned.notify_counties([DALLAS])
+
+    assert notified == ['user-1']
+    assert respawned.pending() == 1
+
+
+def test_started_scheduler_notifies_changes_recorded_elsewhere(path):
+    done = threading.Event()
+
+    def notify(county, subscriptions):
+        done.set()
+        return subscriptions
+
+    # Recorded by a process without a scheduler thread (the gunicorn
+    # master), notified by the thread of another one
+    recorder = SubscriptionScheduler(path=path)
+    recorder.subscribe('user-1', 'token-1', DALLAS, 'TX')
+    recorder.counties_changed([DALLAS])
+    SubscriptionScheduler(notify, path=path).start()
+
+    assert done.wait(5)
+    deadline = time.time() + 5
+    while recorder.pending() and time.time() < deadline:
+        time.sleep(0.01)
+    assert recorder.pending() == 0
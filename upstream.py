@@ -0,0 +1,151 @@
+"""Stale-while-revalidate cache for upstream API responses
+
+A fresh entry is served as is. Once its TTL is over it is still served
+for a grace period while one background thread fetches a new value, and
+concurrent misses on the same key wait for a single upstream call
+instead of each making their own.
+
+Per-source TTLs: Places text search results depend on `opennow`, so they
+live minutes; covidtracking state metadata almost never changes, so it
+lives a day.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from metrics import timed
+
+import requests
+
+MAPS_API_TOKEN = os.environ.get('MAPS_API_TOKEN')
+PLACES_SEARCH_URL = os.environ.get('PLACES_SEARCH_URL',
+                                   'https://maps.googleapis.com/maps/api/place/textsearch/json')
+STATE_INFO_URL = os.environ.get('STATE_INFO_URL',
+                                'https://covidtracking.com/api/v1/states/{}/info.json')
+# (ttl, stale) seconds: served as is during ttl, served while
+# revalidating for stale more seconds
+PLACES_TTL = (300, 900)
+STATE_INFO_TTL = (86400, 7 * 86400)
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamCache(object):
+    """Response cache with background revalidation and request collapsing
+
+    :param max_entries: entries kept before evicting the least recently
+        used one
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.counters = collections.Counter()
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader, ttl, stale):
+        """Returns the value of key, calling loader() only when needed
+
+        :param key: hashable cache key, including the request parameters
+        :param loader: function fetching the value from upstream
+        :param ttl: seconds the value is fresh
+        :param stale: seconds after ttl the value is still served while
+            it is being revalidated
+        :raises: whatever loader raises when there is nothing to serve
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, fetched_at = entry
+                age = now - fetched_at
+                if age < ttl + stale:
+                    self._entries.move_to_end(key)
+                    if age < ttl:
+                        self.counters['hits'] += 1
+                        return value
+                    self.counters['stale_hits'] += 1
+                    if key not in self._inflight:
+                        self._inflight[key] = threading.Event()
+                        thread = threading.Thread(target=self._revalidate, args=(key, loader))
+                        thread.daemon = True
+                        thread.start()
+                    return value
+            waiting = self._inflight.get(key)
+            if waiting is None:
+                self._inflight[key] = threading.Event()
+                self.counters['misses'] += 1
+            else:
+                self.counters['collapsed'] += 1
+        if waiting is not None:
+            waiting.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                return entry[0]
+            # The call we waited for failed, try on our own
+            return self.get(key, loader, ttl, stale)
+        try:
+            return self._load(key, loader)
+        finally:
+            self._done(key)
+
+    def _load(self, key, loader):
+        with self._lock:
+            self.counters['upstream_calls'] += 1
+        value = loader()
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def _done(self, key):
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _revalidate(self, key, loader):
+        try:
+            self._load(key, loader)
+        except Exception:
+            logger.exception('Failed to revalidate %r, serving the stale value', key)
+        finally:
+            self._done(key)
+
+
+upstream_cache = UpstreamCache()
+session = requests.Session()
+
+
+def search_places(dest_type, county):
+    """Searches currently open places of a type in a county
+
+    :param dest_type: place type (Ex- Grocery)
+    :param county: county name (Ex- Dallas County, TX)
+    :returns: list of Places text search results
+    """
+    def load():
+        with timed('places'):
+            response = session.get(PLACES_SEARCH_URL + '?query=' + dest_type + '+' + '+'.join(str(county).split()) +
+                                   '&opennow=true&key=' + MAPS_API_TOKEN, timeout=10)
+        return response.json()['results']
+    return upstream_cache.get(('places', dest_type, county), load, *PLACES_TTL)
+
+
+def state_covid_site(state_short):
+    """Finds the official COVID website of a state
+
+    :param state_short: state name in short (Ex- TX)
+    :returns: website url or None if the state has none
+    """
+    def load():
+        with timed('state_info'):
+            response = session.get(STATE_INFO_URL.format(state_short.lower()), timeout=10)
+        return response.json()['covid19Site']
+    return upstream_cache.get(('state_info', state_short.upper()), load, *STATE_INFO_TTL)
@@ -0,0 +1,11 @@
+"""WSGI entry point of the production server: gunicorn wsgi:app
+
+gunicorn imports this module once in the master (preload_app in
+gunicorn.conf.py), so the read-only data is loaded before the workers
+are forked and shared by them copy-on-write.
+"""
+from app import app, warm_up
+
+__all__ = ['app']
+
+warm_up()